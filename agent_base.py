@@ -1,21 +1,67 @@
 from abc import ABC, ABCMeta
-from queue import Queue
+from asyncio import get_running_loop
+from threading import Event
+from typing import Optional
+
+from protocol import Protocol, JsonProtocol
 
 
 class AgentBase(ABC, metaclass=ABCMeta):
 
+    protocol: Protocol = JsonProtocol()  # agents may replace it with the protocol negotiated during authentication
+
     @staticmethod
-    def poll(agent_queue: Queue):
+    def poll(cancelled: Event) -> Optional['AgentBase']:
+        """
+        Waits for a client to connect. It is called from a thread of the connection manager, and it has to return
+        soon after the polling is cancelled.
+
+        :param cancelled: set when another agent was connected, or the software is stopped
+
+        :return: the connected agent, None if the polling was cancelled or failed
+        """
         raise NotImplementedError
 
     def authenticate(self, password):
         raise NotImplementedError
 
-    def receive(self) -> str:
+    def resume(self, timeout: float) -> bool:
+        """
+        Waits for the client to reconnect after its connection was lost, and to resume its session.
+
+        :param timeout: seconds to wait for the client
+
+        :return: True if the session was resumed, agents without sessions return False
+        """
+        return False
+
+    def interrupt(self) -> None:
+        """
+        Makes the pending and the next receive return as if the connection was closed, e.g. after sending failed, so
+        the receiving side notices the lost connection. Agents without sessions do nothing.
+        """
+
+    def receive(self) -> list:
+        """
+        Blocks until at least one message arrives.
+
+        :return: the received messages, an empty list if the connection is closed
+        """
         raise NotImplementedError
     
-    def send(self, message: str) -> None:
+    def send(self, message: bytes) -> None:
         raise NotImplementedError
 
+    async def receive_async(self) -> list:
+        """
+        Receives on the running event loop. Agents without asynchronous I/O block a thread of the default executor.
+
+        :return: the received messages, an empty list if the connection is closed
+        """
+        return await get_running_loop().run_in_executor(None, self.receive)
+
+    async def send_async(self, message: bytes) -> None:
+        await get_running_loop().run_in_executor(None, self.send, message)
+
     def close_connection(self):
         raise NotImplementedError
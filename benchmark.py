@@ -0,0 +1,260 @@
+"""
+End-to-end latency benchmark of the RC car software, running on the simulated hardware.
+
+A loopback client connects to a LAN_Agent, and drives the whole RC_Car pipeline:
+  * command-to-actuation: from sending a command, until the PWM output of the wheel changes accordingly, the commands
+    are sent at a random phase of the control loop
+  * sensor-to-telemetry: from changing the simulated distance, until an update reflecting the change arrives
+  * throughput: the commands are sent as fast as the connection takes them for a while, without waiting for their
+    effect, and the commands received and applied by the car are counted, only the latest of the commands received
+    together is applied
+
+:examples:
+
+    python benchmark.py --iterations 200
+    python benchmark.py --asyncio --delta-telemetry --protocol BINARY --udp
+"""
+from argparse import ArgumentParser
+from hashlib import sha256
+from select import select
+from socket import socket, create_connection, AF_INET, SOCK_DGRAM
+from threading import Thread, Condition
+from random import uniform
+from time import monotonic, sleep
+
+from utils.backend import set_backend, SimulatedBackend, SimulatedWorld
+from utils.constants import FORWARD, DISTANCE, SEQUENCE
+from protocol import PROTOCOLS
+from lan_agent import LAN_Agent
+from rc_software import RC_Car
+
+HOST = '127.0.0.1'
+PASSWORD = sha256('69420'.encode()).digest()
+WHEEL_PIN = 7  # forward pin of the right wheel
+NEAR, FAR = 0.3, 0.6  # simulated distances in meters, alternated by the sensor-to-telemetry scenario
+TIMEOUT = 5
+
+
+class LoopbackClient:
+    """
+    Minimal client of the LAN_Agent: sends commands, acknowledges and records the updates.
+    """
+
+    def __init__(self, port: int, protocol: str, udp: bool):
+        self.port = port
+        self.protocol = PROTOCOLS[protocol]
+        self.command_socket = create_connection((HOST, port))
+        self.update_socket = create_connection((HOST, port))
+        self.datagram_socket = socket(AF_INET, SOCK_DGRAM) if udp else None
+
+        options = [protocol] + (['UDP'] if udp else [])
+        self.command_socket.sendall(PASSWORD + ' '.join(options).encode())
+
+        self.sequence = 0
+        self.sent = 0
+        self.values = dict()
+        self.updates = []  # (arrival time, values) pairs
+        self.updated = Condition()
+        self.running = True
+
+    def start(self) -> None:
+        """
+        Waits until the car grants access, then starts recording the updates.
+        """
+        granted = self.update_socket.recv(1024)
+        assert granted.startswith(b'GRANTED'), granted
+        Thread(target=self.__receive_updates, daemon=True).start()
+
+    def send(self, command: dict) -> float:
+        """
+        :return: the time the command was sent
+        """
+        self.sequence += 1
+        message = self.protocol.encode({SEQUENCE: self.sequence, **command})
+        sent_at = monotonic()
+        if self.datagram_socket is not None:
+            self.datagram_socket.sendto(message, (HOST, self.port))
+        else:
+            self.command_socket.sendall(message)
+        self.sent += 1
+        return sent_at
+
+    def wait_for_update(self, condition, since: float) -> float:
+        """
+        :return: the arrival time of the first update after since, whose values satisfy the condition
+        """
+        deadline = monotonic() + TIMEOUT
+        with self.updated:
+            while True:
+                for arrived_at, values in reversed(self.updates):
+                    if arrived_at < since:
+                        break
+                    if condition(values):
+                        return arrived_at
+                assert monotonic() < deadline, 'no matching update received'
+                self.updated.wait(deadline - monotonic())
+
+    def close(self) -> None:
+        self.running = False
+        self.command_socket.close()
+        self.update_socket.close()
+        if self.datagram_socket is not None:
+            self.datagram_socket.close()
+
+    def __receive_updates(self) -> None:
+        sockets = [self.update_socket] + ([self.datagram_socket] if self.datagram_socket is not None else [])
+        received = bytearray()
+        while self.running:
+            try:
+                readable, _, _ = select(sockets, [], [], TIMEOUT)
+                if not readable:
+                    continue
+                chunk = readable[0].recv(1024)
+            except (OSError, ValueError):
+                return
+            if not chunk:
+                return
+            arrived_at = monotonic()
+            if readable[0] is self.update_socket:
+                received += chunk
+                messages = self.protocol.split(received)
+                self.update_socket.sendall(b'\n' * len(messages))
+            else:
+                messages = [chunk]
+
+            with self.updated:
+                for message in messages:
+                    self.values.update(self.protocol.decode(message))
+                    self.updates.append((arrived_at, dict(self.values)))
+                self.updated.notify_all()
+
+
+def percentile(samples: list, ratio: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+
+def report(name: str, latencies: list) -> None:
+    milliseconds = [latency * 1000 for latency in latencies]
+    print(f'{name:<24} n={len(milliseconds):<5} p50={percentile(milliseconds, 0.5):8.2f} ms  '
+          f'p99={percentile(milliseconds, 0.99):8.2f} ms  max={max(milliseconds):8.2f} ms')
+
+
+def first_change(pwm, since: float, condition) -> float:
+    """
+    :return: the time of the first duty cycle change of the PWM output after since, which satisfies the condition
+    """
+    deadline = monotonic() + TIMEOUT
+    while monotonic() < deadline:
+        for changed_at, duty_cycle in list(pwm.history):
+            if changed_at >= since and condition(duty_cycle):
+                return changed_at
+        sleep(0.0005)
+    raise AssertionError('the wheel was not actuated')
+
+
+def command_to_actuation(client: LoopbackClient, backend: SimulatedBackend, iterations: int, period: float) -> list:
+    """
+    Every command is sent after a random delay of up to one control loop period, otherwise they would all be sent
+    right after a flush of the outputs, and wait for almost a whole period.
+    """
+    wheel = backend.pwms[WHEEL_PIN]
+    latencies = []
+    for _ in range(iterations):
+        sleep(uniform(0, period))
+        sent_at = client.send({FORWARD: True})
+        latencies.append(first_change(wheel, sent_at, lambda duty_cycle: duty_cycle > 0) - sent_at)
+        sleep(uniform(0, period))
+        sent_at = client.send({FORWARD: False})
+        latencies.append(first_change(wheel, sent_at, lambda duty_cycle: duty_cycle == 0) - sent_at)
+    return latencies
+
+
+def command_throughput(client: LoopbackClient, car: RC_Car, duration: float) -> tuple:
+    """
+    Sends commands open loop for the duration, then waits until the car received all of them, that arrived.
+
+    :return: commands per second sent, received and applied by the car
+    """
+    received, dropped = car.received_commands.value, car.dropped_commands.value
+    sent = client.sent
+    started_at = monotonic()
+    forward = False
+    while monotonic() - started_at < duration:
+        forward = not forward
+        client.send({FORWARD: forward})
+    elapsed = monotonic() - started_at
+    sent = client.sent - sent
+
+    while True:  # the backlog is still processed by the car
+        before = car.received_commands.value
+        sleep(0.1)
+        if car.received_commands.value == before:
+            break
+
+    received = car.received_commands.value - received
+    applied = received - (car.dropped_commands.value - dropped)
+    return sent / elapsed, received / elapsed, applied / elapsed
+
+
+def sensor_to_telemetry(client: LoopbackClient, world: SimulatedWorld, iterations: int) -> list:
+    threshold = (NEAR + FAR) / 2 * 100
+    latencies = []
+    for iteration in range(iterations):
+        near = iteration % 2 == 0
+        changed_at = monotonic()
+        world.distance = NEAR if near else FAR
+        if near:
+            arrived_at = client.wait_for_update(lambda values: values.get(DISTANCE, threshold) < threshold, changed_at)
+        else:
+            arrived_at = client.wait_for_update(lambda values: values.get(DISTANCE, threshold) > threshold, changed_at)
+        latencies.append(arrived_at - changed_at)
+    return latencies
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--port', type=int, default=16000)
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='JSON')
+    parser.add_argument('--udp', action='store_true')
+    parser.add_argument('--asyncio', action='store_true')
+    parser.add_argument('--delta-telemetry', action='store_true')
+    parser.add_argument('--metrics-port', type=int)
+    parser.add_argument('--throughput-duration', type=float, default=2.0, help='seconds of the open loop throughput run')
+    arguments = parser.parse_args()
+
+    world = SimulatedWorld(distance=FAR)
+    backend = SimulatedBackend(world)
+    set_backend(backend)
+
+    agents = []
+    agent_thread = Thread(target=lambda: agents.append(LAN_Agent(port=arguments.port, announce=False)))
+    agent_thread.start()
+    sleep(0.1)
+    client = LoopbackClient(arguments.port, arguments.protocol, arguments.udp)
+    agent_thread.join()
+
+    car = RC_Car(delta_telemetry=arguments.delta_telemetry, asynchronous=arguments.asyncio, agent=agents[0],
+                 metrics_port=arguments.metrics_port, session_grace=0)
+    client.start()
+    car_thread = Thread(target=car.run)
+    car_thread.start()
+
+    actuation = command_to_actuation(client, backend, arguments.iterations, car.control_loop.period)
+    updates, started_at = len(client.updates), monotonic()
+    telemetry = sensor_to_telemetry(client, world, arguments.iterations)
+    update_rate = (len(client.updates) - updates) / (monotonic() - started_at)
+    sent, received, applied = command_throughput(client, car, arguments.throughput_duration)
+
+    client.close()
+    car_thread.join()
+
+    report('command-to-actuation', actuation)
+    report('sensor-to-telemetry', telemetry)
+    print(f'throughput: {sent:.0f} commands/s sent, {received:.0f} received, {applied:.0f} applied')
+    print(f'telemetry: {update_rate:.1f} updates/s, {car.control_loop.overruns} control loop overruns')
+
+
+if __name__ == '__main__':
+    main()
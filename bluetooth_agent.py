@@ -1,15 +1,18 @@
 from agent_base import AgentBase
+from utils.log import get_logger
+
+logger = get_logger('bluetooth_agent')
 
 
 class BluetoothAgent(AgentBase):
 
     def __init__(self):
-        print('not yet')
+        logger.warning('not yet')
 
-    def receive(self) -> str:
+    def receive(self) -> list:
         raise NotImplementedError
 
-    def send(self, message: str) -> None:
+    def send(self, message: bytes) -> None:
         raise NotImplementedError
 
     def receive_password(self) -> str:
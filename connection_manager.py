@@ -0,0 +1,103 @@
+from queue import Queue
+from threading import Thread, Event, Lock
+from time import monotonic
+from typing import Optional
+
+from agent_base import AgentBase
+from utils.log import get_logger
+
+logger = get_logger('connection_manager')
+
+
+class ConnectionManager:
+    """
+    Polls every type of agent at the same time, each in its own thread of this process. The first agent, whose client
+    authenticates, is handed to the car, and the polling of the other types is cancelled. The threads of the cancelled
+    types close any agent they connect afterwards, and exit.
+
+    :examples:
+    >>> manager = ConnectionManager(password, (LAN_Agent, DS4Agent))
+    >>> agent = manager.connect()
+    """
+
+    RETRY_PERIOD = 5  # seconds to wait after a failed poll, before polling the same type of agent again
+
+    def __init__(self, password: bytes, agent_types: tuple):
+        """
+        :param password: the password hash the clients have to authenticate with
+        :param agent_types: the subclasses of AgentBase to poll
+        """
+        self.password = password
+        self.agent_types = agent_types
+        self.lock = Lock()
+        self.cancelled = Event()
+
+    def connect(self, agent: Optional[AgentBase] = None) -> AgentBase:
+        """
+        Blocks until an agent is connected and authenticated.
+
+        :Assumptions: It is not called again, until it returns
+
+        :param agent: an already connected agent, the agent types are only polled, if it fails to authenticate
+
+        :return: the authenticated agent
+        """
+        if agent is not None:
+            if agent.authenticate(self.password):
+                return agent
+            agent.close_connection()
+
+        started = monotonic()
+        self.cancelled = Event()
+        connected = Queue()
+        for agent_type in self.agent_types:
+            Thread(target=self.__poll, args=(agent_type, self.cancelled, connected), daemon=True).start()
+
+        agent = connected.get()
+        logger.info('%s agent connected in %.1f s', agent, monotonic() - started)
+        return agent
+
+    def cancel(self) -> None:
+        """
+        Stops polling the agents, if connect is in progress.
+
+        :Assumptions: None
+
+        :return: None
+        """
+        self.cancelled.set()
+
+    def __poll(self, agent_type: type, cancelled: Event, connected: Queue) -> None:
+        """
+        Polls one type of agent, until one of its clients authenticates, or the polling is cancelled.
+
+        :Assumptions: None
+
+        :param agent_type: the subclass of AgentBase to poll
+        :param cancelled: set by the winner, it is not shared with the later calls of connect
+        :param connected: the winner is put into it
+
+        :return: None
+        """
+        while not cancelled.is_set():
+            try:
+                agent = agent_type.poll(cancelled)
+            except NotImplementedError:
+                logger.debug('%s can not be polled', agent_type.__name__)
+                return
+            except Exception:
+                logger.exception('polling %s failed', agent_type.__name__)
+                agent = None
+
+            if agent is None:
+                cancelled.wait(self.RETRY_PERIOD)
+            elif cancelled.is_set() or not agent.authenticate(self.password):
+                agent.close_connection()
+            else:
+                with self.lock:
+                    won = not cancelled.is_set()
+                    cancelled.set()
+                if won:
+                    connected.put(agent)
+                else:
+                    agent.close_connection()
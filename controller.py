@@ -1,10 +1,17 @@
-from gpiozero import LineSensor, DistanceSensor
 from utils.output_devices import Buzzer
 from lighting import Lights
 from motor import Motor
-from collections import defaultdict
 from typing import Optional
 from utils.constants import * 
+from utils.control_state import ControlState
+from utils.sampling import DistanceSampler
+from utils.runtime import ThreadRuntime
+from utils.animation import AnimationEngine
+from utils.output_batch import output_batch
+from utils.backend import get_backend
+from utils.log import get_logger
+
+logger = get_logger('controller')
 
 
 class Controller:
@@ -14,28 +21,39 @@ class Controller:
     :examples:
     >>> control = Controller()
     >>> control.set_values({'forward': True, 'lights': True}) # move the car forward, with the lights on
-    >>> dict(control.get_values())
-    {"forward": True, "lights": True}
+    >>> control.get_values()
+    {"forward": True, "backward": False, ..., "lights": True, ..., "distance": 20.0, "speed": 3.6}
     """
 
-    def __init__(self, pin_numbering=None):
+    def __init__(self, pin_numbering=None, runtime=None, control_loop=None):
         """
         Initialises the GPIO components, and other controll components
 
         :Assumptions: None
 
         :param pin_numbering: ignored, added so it is possible to parse the GPIO pins from file in the future
+        :param runtime: runs the animations of the lights, if there is no control loop, by default in a new thread
+        :param control_loop: the fixed rate scheduler, which runs the behaviours of the motor, and the animations of
+            the lights, the outputs are written together after its ticks
         """
-        # self.buzzer = Buzzer(17)
-        # self.lights = Lights([18,22], [20, 21, 26], 23, 27)
-        # self.distance_sensor = DistanceSensor(echo=4, trigger=3)
-        # self.line_sensor = LineSensor(24)
-        # self.motor = Motor([7, 8], [9, 10]) 
+        self.states = ControlState()  # shared with the motor and the lights, each writes its own fields
+        self.command = ControlState()  # the latest command, loaded in place
+
+        self.buzzer = Buzzer(17)
+        self.animation_engine = AnimationEngine()
+        (control_loop or runtime or ThreadRuntime()).start(self.animation_engine.run())
+        self.lights = Lights([18,22], [20, 21, 26], 23, 27, engine=self.animation_engine, states=self.states)
+        self.distance_sensor = get_backend().distance_sensor(echo=4, trigger=3)
+        self.distance_sampler = DistanceSampler(self.distance_sensor)
+        ThreadRuntime().start(self.distance_sampler.run())  # the readings block, so they get their own thread
+        self.line_sensor = get_backend().line_sensor(24)
+        self.motor = Motor([7, 8], [9, 10], control_loop, self.distance_sampler, self.states)
 
-        # self.line_sensor.when_line = lambda: self.__set_line(True)
-        # self.line_sensor.when_no_line = lambda: self.__set_line(False)
+        if control_loop is not None:
+            output_batch.defer(control_loop)
 
-        self.states = defaultdict(bool)
+        self.line_sensor.when_line = lambda: self.__set_line(True)
+        self.line_sensor.when_no_line = lambda: self.__set_line(False)
 
     def __honk(self, horn_pushed: bool) -> None:
         """
@@ -47,11 +65,10 @@ class Controller:
 
         :return: None
         """
-        # if horn_pushed and not self.buzzer.is_active:
-        #     self.buzzer.on()
-        # elif not horn_pushed and self.buzzer.is_active:
-        #     self.buzzer.off()
-        pass
+        if horn_pushed and not self.buzzer.is_active:
+            self.buzzer.on()
+        elif not horn_pushed and self.buzzer.is_active:
+            self.buzzer.off()
 
     def __set_line(self, line_detected: bool) -> None:
         """
@@ -63,9 +80,8 @@ class Controller:
 
         :return: None
         """
-        # self.states[LINE] = line_detected
-        # self.motor.line_detected = line_detected
-        pass
+        self.states[LINE] = line_detected
+        self.motor.line_detected = line_detected
 
     def set_values(self, data: dict):
         """
@@ -77,33 +93,58 @@ class Controller:
 
         :return: None
         """
-        default_data = defaultdict(bool, data)
+        command = self.command.load(data)
+
+        if command[FORWARD]:
+            logger.debug('FORWARD')
 
-        if data[FORWARD]:
-            print('FORWARD')
+        with self.states:  # the snapshots contain the whole command applied, or nothing of it
+            self.motor.handle_motor_control(command)
+            command[BACKWARD] = self.states[BACKWARD]
+            self.lights.handle_lights(command)
+        self.__honk(command[HORN])
+
+    def brake(self) -> None:
+        """
+        Brakes the car and silences the horn, when the commands of the client stopped arriving. The lights are left as
+        they are.
 
-        default_data[DISTANCE] = self.states[DISTANCE]
-        # self.motor.handle_motor_control(default_data)  
-        # default_data[BACKWARD] = self.motor.states[BACKWARD]
-        # self.lights.handle_lights(default_data)
-        # self.__honk(default_data[HORN])
+        :Assumptions: None
+
+        :return: None
+        """
+        self.motor.brake()
+        self.__honk(False)
 
-    def get_values(self) -> dict:
+    def close(self) -> None:
+        """
+        Stops the car, turns off the lights and the buzzer, and stops sampling the distance sensor.
+
+        :Assumptions: None
+
+        :return: None
+        """
+        self.motor.stop()
+        self.command.clear()
+        with self.states:
+            self.lights.handle_lights(self.command)
+        self.__honk(False)
+        self.animation_engine.close()
+        self.distance_sampler.stop()
+        output_batch.flush_immediately()
+
+    def get_values(self, values: Optional[dict] = None) -> dict:
         """
         Sets two additional paramaters, then returns the state of the car.
 
         :Assumptions: None
 
+        :param values: filled with the state, so the caller can reuse the same dict on every update, a new dict by
+            default
+
         :return: state as key-value pairs
         """
-        # for key, value in self.motor.get_data():
-        #     self.states[key] = value 
-        # for key, value in self.lights.get_data():
-        #     self.states[key] = value
-
-        # distance = round(self.distance_sensor.distance * 100, 2)
-        # self.states[DISTANCE] = distance
-        # self.motor.distance = distance
-        # self.states[SPEED] = round(self.motor.current_speed * 3.6 * 10, 2)
+        self.states[DISTANCE] = round(self.distance_sampler.smoothed, 2)
+        self.states[SPEED] = round(self.motor.current_speed * 3.6 * 10, 2)
 
-        return dict(self.states)
+        return self.states.snapshot(values if values is not None else dict())
@@ -0,0 +1,85 @@
+from select import select
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR
+from threading import Thread, Event
+from time import monotonic
+from typing import Optional
+
+from utils.log import get_logger
+
+logger = get_logger('discovery')
+
+DISCOVERY_PORT = 16001
+QUERY = b'RC_CAR DISCOVER\n'
+REPLY_PREFIX = b'RC_CAR '  # followed by the port of the LAN agent, and a newline
+
+
+class DiscoveryResponder:
+    """
+    Lets the clients find the car on the local network without a server on the internet: the clients broadcast a
+    query to the discovery port, and the responder answers with the port of the LAN agent. The address of the car is
+    the source address of the answer.
+
+    :examples:
+    >>> responder = DiscoveryResponder(16000)
+    >>> responder.start()
+    >>> discover()
+    ('192.168.0.42', 16000)
+    >>> responder.stop()
+    """
+
+    POLL_PERIOD = 0.5  # seconds between the checks of the stop request
+
+    def __init__(self, service_port: int, discovery_port: int = DISCOVERY_PORT):
+        """
+        :param service_port: the port of the LAN agent, sent to the clients
+        :param discovery_port: the port the queries are broadcast to
+        """
+        self.reply = REPLY_PREFIX + str(service_port).encode() + b'\n'
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', discovery_port))
+        self.stopped = Event()
+
+    def start(self) -> None:
+        Thread(target=self.__respond, daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def __respond(self) -> None:
+        try:
+            while not self.stopped.is_set():
+                readable, _, _ = select([self.socket], [], [], self.POLL_PERIOD)
+                if not readable:
+                    continue
+                query, address = self.socket.recvfrom(64)
+                if query == QUERY:
+                    logger.debug('discovered by %s', address)
+                    self.socket.sendto(self.reply, address)
+        finally:
+            self.socket.close()
+
+
+def discover(timeout: float = 1.0, discovery_port: int = DISCOVERY_PORT) -> Optional[tuple]:
+    """
+    Finds a car on the local network, it is used by the clients.
+
+    :Assumptions: None
+
+    :param timeout: seconds to wait for an answer
+    :param discovery_port: the port the responder of the car listens on
+
+    :return: the (host, port) address of the LAN agent of the first car answering, None if none answered
+    """
+    deadline = monotonic() + timeout
+    with socket(AF_INET, SOCK_DGRAM) as client:
+        client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        client.sendto(QUERY, ('<broadcast>', discovery_port))
+        while monotonic() < deadline:
+            readable, _, _ = select([client], [], [], deadline - monotonic())
+            if not readable:
+                break
+            reply, (host, _) = client.recvfrom(64)
+            if reply.startswith(REPLY_PREFIX) and reply.endswith(b'\n'):
+                return host, int(reply[len(REPLY_PREFIX):])
+    return None
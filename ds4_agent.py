@@ -1,86 +1,361 @@
-from abc import ABC
-from multiprocessing import Queue
-from multiprocessing import Pipe
 from pathlib import Path
-from threading import Thread
-from time import sleep
+from threading import Event
 
 from agent_base import AgentBase
-from subprocess import Popen, PIPE
-from re import finditer
-from multiprocessing import Process
+from subprocess import Popen, PIPE, TimeoutExpired
+from re import compile, MULTILINE
 
-from utils.constants import FORWARD
-from json import dumps
-from ps4 import MyController, read
-from os import kill
-from signal import SIGTERM
+from asyncio import get_running_loop, wait_for, TimeoutError
+from select import select
+from time import perf_counter
+from typing import Optional
+
+from protocol import LocalProtocol
+from utils.constants import FORWARD, BACKWARD, LEFT, RIGHT, THROTTLE, STEERING, REVERSE, HORN, LIGHTS, HAZARD_WARNING, L_INDICATOR, \
+    R_INDICATOR, DISTANCE_KEEPING, LINE_FOLLOWING, KEEP_CONTAINED, CHANGE_DIRECTION
+from utils.metrics import metrics
+from utils.log import get_logger
+
+logger = get_logger('ds4_agent')
 
 
 class DS4Agent(AgentBase):
+    """
+    Agent of a DualShock 4 controller connected over Bluetooth. The input device of the controller is read directly
+    with evdev, every message is the whole user input as a dict, which is only produced when it changed.
+
+    Mapping of the controller:
+      * left stick: throttle and steering, and forward, backward, left, right derived from them
+      * cross (held): horn
+      * triangle, square, L1, R1, circle (toggled): lights, hazard warning, left and right indicator, reverse
+      * D-pad up, down, left (toggled): distance keeping, line following, keep contained
+      * D-pad right (pressed): change direction, only the first message after the press contains it
+    """
+
+    protocol = LocalProtocol()
+
+    STICK_AXES = ('ABS_X', 'ABS_Y')
+    DEAD_ZONE = 0.2  # ratio of the half range of a stick axis, within which the stick is considered centered
+    RESOLUTION = 0.05  # the positions of the sticks are rounded to it, so the noise does not produce messages
+    REPEAT_PERIOD = 0.2  # seconds after which an unchanged user input is repeated, so the watchdog is fed
+    HELD_BUTTONS = {'BTN_SOUTH': HORN}
+    TOGGLED_BUTTONS = {
+        'BTN_NORTH': LIGHTS,
+        'BTN_WEST': HAZARD_WARNING,
+        'BTN_TL': L_INDICATOR,
+        'BTN_TR': R_INDICATOR,
+        'BTN_EAST': REVERSE,
+    }
+    TOGGLED_DIRECTIONS = {  # (D-pad axis, value): field
+        ('ABS_HAT0Y', -1): DISTANCE_KEEPING,
+        ('ABS_HAT0Y', 1): LINE_FOLLOWING,
+        ('ABS_HAT0X', -1): KEEP_CONTAINED,
+    }
+    PRESSED_DIRECTIONS = {  # (D-pad axis, value): field, True in the next message only, it is not repeated
+        ('ABS_HAT0X', 1): CHANGE_DIRECTION,
+    }
+
+    receive_time = metrics.histogram('agent.receive')
 
     @staticmethod
-    def poll(agent_queue: Queue):
-        ds4_instance = DS4Agent()
-        print("Creation of ds4_agent was successful")
-        agent_queue.put(ds4_instance)
-        sleep(5)
-
-    def __init__(self):
-
-        connected = False
-        while not connected:
-            mac_addr = None
-            while not mac_addr:
-                proc = Popen(args="hcitool scan", stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-                try:
-                    stdout, stderr = proc.communicate(timeout=30)
-                    matches_iterator = finditer(r'(\w{2}:){5}\w{2}', stdout)
-                    while not mac_addr:
-                        try:
-                            matching_addr = next(matches_iterator)
-                            device_name = stdout.split(matching_addr.group(0))[1].split('\n')[0].strip()
-                            print(f'addr: {matching_addr.group(0)}, dev name: {device_name}')
-                            if device_name == 'Wireless Controller':
-                                mac_addr = matching_addr.group(0)
-                        except StopIteration:
-                            break
-                except Exception as e: # TODO: handle timeout
-                    print("no available devices")
-
-            print('final addr: ', mac_addr)
-            proc = Popen(args=f"sudo /home/alex/rc_controller_software/sh/connect {mac_addr}", stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
+    def poll(cancelled: Event) -> Optional['DS4Agent']:
+        ds4_instance = DS4Agent(cancelled)
+        if not ds4_instance.connected:
+            return None
+        logger.info("Creation of ds4_agent was successful")
+        return ds4_instance
 
-            try:
-                stdout, stderr = proc.communicate(timeout=30)
-                print('stdout: ', stdout)
-                print('stderr: ', stderr)
-            except Exception as e:
-                print("process not finished yet?", e)
-            finally:
-                proc.terminate()
+    DEVICE_NAME = 'Wireless Controller'
+    KNOWN_DEVICES_FILE = Path.home() / '.rc_car' / 'ds4_devices'  # MAC addresses, the last connected one first
+    SCRIPTS = Path(__file__).parent / 'sh'
+    SCAN_TIMEOUT = 30
+    CONNECT_TIMEOUT = 10
+    PAIR_TIMEOUT = 30
+    DEVICE_PATTERN = compile(r'^\s*((?:\w{2}:){5}\w{2})\s+(.*?)\s*$', MULTILINE)
+
+    def __init__(self, cancelled: Optional[Event] = None):
+        """
+        Connects to a known controller, or scans for a new one, until one is connected.
+
+        :param cancelled: if it is set before a controller is connected, the connected attribute is left False
+        """
+        self.cancelled = cancelled or Event()
+        self.connected = False
+        self.device = None
+        while not self.connected and not self.cancelled.is_set():
+            for mac_addr in self.__known_devices():
+                logger.info('reconnecting to %s', mac_addr)
+                self.__run(['sudo', 'bluetoothctl', 'connect', mac_addr], self.CONNECT_TIMEOUT)
+                if self.__is_connected(mac_addr):
+                    break
+            else:
+                mac_addr = self.__scan()
+                if mac_addr is None:
+                    break
+                logger.info('final addr: %s', mac_addr)
+                self.__run(['sudo', str(self.SCRIPTS / 'connect'), mac_addr], self.PAIR_TIMEOUT)
+                if not self.__is_connected(mac_addr):
+                    logger.info('not connected')
+                    continue
+
+            self.__remember(mac_addr)
+            self.connected = True
+
+    @staticmethod
+    def __run(args: list, timeout: float) -> str:
+        """
+        :return: the standard output of the command, empty if it did not finish in time
+        """
+        proc = Popen(args=args, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+            logger.debug('%s stdout: %s stderr: %s', args[1], stdout, stderr)
+            return stdout
+        except TimeoutExpired:
+            logger.warning('%s did not finish in %s s', ' '.join(args), timeout)
+            return ''
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def __is_connected(self, mac_addr: str) -> bool:
+        return mac_addr in self.__run(['hcitool', 'con'], 5)
+
+    def __scan(self) -> Optional[str]:
+        """
+        Scans until a controller is found.
+
+        :Assumptions: The controller is in pairing mode
+
+        :return: the MAC address of the first found controller, None if the polling was cancelled
+        """
+        while not self.cancelled.is_set():
+            stdout = self.__run(['hcitool', 'scan'], self.SCAN_TIMEOUT)
+            for match in self.DEVICE_PATTERN.finditer(stdout):
+                logger.debug('addr: %s, dev name: %s', match.group(1), match.group(2))
+                if match.group(2) == self.DEVICE_NAME:
+                    return match.group(1)
+            logger.info("no available devices")
+
+    def __known_devices(self) -> list:
+        """
+        :return: the MAC addresses of the controllers connected before, the last connected one first
+        """
+        try:
+            return self.KNOWN_DEVICES_FILE.read_text().split()
+        except OSError:
+            return []
+
+    def __remember(self, mac_addr: str) -> None:
+        """
+        Moves the MAC address to the front of the known devices, so it is tried first on the next start.
+
+        :Assumptions: None
+
+        :param mac_addr: the MAC address of the connected controller
+
+        :return: None
+        """
+        known_devices = [mac_addr] + [known for known in self.__known_devices() if known != mac_addr]
+        try:
+            self.KNOWN_DEVICES_FILE.parent.mkdir(parents=True, exist_ok=True)
+            self.KNOWN_DEVICES_FILE.write_text('\n'.join(known_devices) + '\n')
+        except OSError as e:
+            logger.warning('could not save the known devices: %s', e)
+
+    def authenticate(self, password):
+        """
+        Opens the input device of the connected controller. It is not opened by the constructor, so a controller
+        connected after another agent won is not grabbed.
 
-            proc = Popen(args="hcitool con", stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
+        :Assumptions: None
+
+        :param password: not used, the controller is trusted, once it is paired
+
+        :return: True if the input device of the controller was found
+        """
+        from evdev import InputDevice, list_devices, ecodes
+
+        self.device = None
+        for path in list_devices():
+            device = InputDevice(path)
+            if device.name.endswith(self.DEVICE_NAME) and ecodes.EV_ABS in device.capabilities():
+                self.device = device
+                break
+            device.close()
+        if self.device is None:
+            logger.warning('input device of the controller not found')
+            return False
+
+        self.ecodes = ecodes
+        self.stick_codes = [ecodes.ecodes[name] for name in self.STICK_AXES]
+        self.stick_ranges = {code: (self.device.absinfo(code).min, self.device.absinfo(code).max)
+                             for code in self.stick_codes}
+        self.held_buttons = {ecodes.ecodes[name]: field for name, field in self.HELD_BUTTONS.items()}
+        self.toggled_buttons = {ecodes.ecodes[name]: field for name, field in self.TOGGLED_BUTTONS.items()}
+        self.toggled_directions = {(ecodes.ecodes[name], value): field
+                                   for (name, value), field in self.TOGGLED_DIRECTIONS.items()}
+        self.pressed_directions = {(ecodes.ecodes[name], value): field
+                                   for (name, value), field in self.PRESSED_DIRECTIONS.items()}
+
+        self.stick = {code: 0.0 for code in self.stick_codes}
+        self.held = {field: False for field in self.held_buttons.values()}
+        self.toggled = {field: False for field in (*self.toggled_buttons.values(), *self.toggled_directions.values())}
+        self.pressed = {field: False for field in self.pressed_directions.values()}  # since the last message
+        self.frame = []  # events of the frame being read, they are applied together at the end of the frame
+        self.dropped = False  # the kernel dropped events, the state is read from the device at the end of the frame
+        self.values = None  # the last returned user input
+        self.__resynchronize()
+        return True
+
+    def receive(self) -> list:
+        """
+        Waits until the user input changes, or REPEAT_PERIOD passes.
+
+        :Assumptions: The agent is authenticated
+
+        :return: a list containing the current user input, an empty list if the controller was disconnected
+        """
+        values = None
+        while values is None:
             try:
-                stdout, stderr = proc.communicate(timeout=5)
-                if mac_addr in stdout:
-                    connected = True
-                    # TODO: implement actual controller
-                else:
-                    print('not connected')
+                readable, _, _ = select([self.device.fd], [], [], self.REPEAT_PERIOD)
+                values = self.__read() if readable else self.__repeat()
+            except OSError:
+                logger.info('controller disconnected')
+                return []
+        return [values]
+
+    async def receive_async(self) -> list:
+        """
+        Same as receive, but waits for the input device on the running event loop instead of blocking the thread.
 
+        :Assumptions: The agent is authenticated
+
+        :return: a list containing the current user input, an empty list if the controller was disconnected
+        """
+        loop = get_running_loop()
+        values = None
+        while values is None:
+            readable = loop.create_future()
+            loop.add_reader(self.device.fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await wait_for(readable, self.REPEAT_PERIOD)
+                values = self.__read()
+            except TimeoutError:
+                values = self.__repeat()
+            except OSError:
+                logger.info('controller disconnected')
+                return []
             finally:
-                proc.terminate()
+                loop.remove_reader(self.device.fd)
+        return [values]
 
-    def authenticate(self, password):
-        return True  # TODO: implement authentication
+    def __read(self) -> Optional[dict]:
+        """
+        Reads the pending events without blocking, and applies the complete frames.
 
-    def receive(self) -> str:
-        raise NotImplementedError
+        :Assumptions: The agent is authenticated
 
-    def send(self, message: str) -> None:
-        raise NotImplementedError
+        :return: the user input if it changed, None otherwise
+        """
+        started = perf_counter()
+        try:
+            for event in self.device.read():
+                self.__handle_event(event)
+        except BlockingIOError:
+            pass
+        self.receive_time.observe(perf_counter() - started)
 
-    def close_connection(self):
-        """TODO: explain why is this function empty"""
+        x, y = (self.stick[code] for code in self.stick_codes)
+        values = {THROTTLE: -y, STEERING: x, FORWARD: y < 0, BACKWARD: y > 0, LEFT: x < 0, RIGHT: x > 0, **self.held,
+                  **self.toggled, **self.pressed}
+        if values == self.values:
+            return None
+        for field in self.pressed:
+            self.pressed[field] = False  # the press is sent once
+        self.values = {**values, **self.pressed}  # the repetitions do not contain the press
+        return values
+
+    def __repeat(self) -> Optional[dict]:
+        """
+        :return: the last returned user input, None if there is none yet
+        """
+        return dict(self.values) if self.values is not None else None
+
+    def __handle_event(self, event) -> None:
+        if event.type != self.ecodes.EV_SYN:
+            self.frame.append(event)
+        elif event.code == self.ecodes.SYN_DROPPED:
+            self.frame.clear()
+            self.dropped = True
+        elif event.code == self.ecodes.SYN_REPORT:
+            if self.dropped:
+                self.__resynchronize()
+                self.dropped = False
+            else:
+                for frame_event in self.frame:
+                    self.__apply(frame_event)
+            self.frame.clear()
+
+    def __apply(self, event) -> None:
+        """
+        Applies an event of a complete frame to the state of the controller.
+
+        :Assumptions: None
+
+        :param event: key or absolute axis event
+
+        :return: None
+        """
+        if event.type == self.ecodes.EV_ABS:
+            if event.code in self.stick:
+                self.stick[event.code] = self.__normalize(event.code, event.value)
+            elif (event.code, event.value) in self.toggled_directions:
+                field = self.toggled_directions[event.code, event.value]
+                self.toggled[field] = not self.toggled[field]
+            elif (event.code, event.value) in self.pressed_directions:
+                self.pressed[self.pressed_directions[event.code, event.value]] = True
+        elif event.type == self.ecodes.EV_KEY:
+            if event.code in self.held_buttons:
+                self.held[self.held_buttons[event.code]] = event.value != 0
+            elif event.code in self.toggled_buttons and event.value == 1:  # pressed, not released or repeated
+                field = self.toggled_buttons[event.code]
+                self.toggled[field] = not self.toggled[field]
+
+    def __normalize(self, code: int, value: int) -> float:
+        """
+        :return: the position of the stick axis between -1 and 1 rounded to the resolution, 0 within the dead zone,
+            the range outside of the dead zone is scaled to start from 0
+        """
+        low, high = self.stick_ranges[code]
+        position = (2 * value - low - high) / (high - low)
+        if abs(position) < self.DEAD_ZONE:
+            return 0.0
+        magnitude = min(1.0, (abs(position) - self.DEAD_ZONE) / (1 - self.DEAD_ZONE))
+        magnitude = round(magnitude / self.RESOLUTION) * self.RESOLUTION
+        return magnitude if position > 0 else -magnitude
+
+    def __resynchronize(self) -> None:
+        """
+        Reads the state of the sticks and held buttons from the device, after events were dropped. The toggles are
+        kept, as the presses in between are lost.
+        """
+        for code in self.stick_codes:
+            self.stick[code] = self.__normalize(code, self.device.absinfo(code).value)
+        active_keys = set(self.device.active_keys())
+        for code, field in self.held_buttons.items():
+            self.held[field] = code in active_keys
+
+    def send(self, message: dict) -> None:
+        """
+        The controller has no display, the updates are dropped.
+        """
         pass
+
+    def close_connection(self):
+        """
+        Closes the input device, the Bluetooth connection itself is left to the controller.
+        """
+        if getattr(self, 'device', None) is not None:
+            self.device.close()
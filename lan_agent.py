@@ -1,14 +1,25 @@
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, timeout as SocketConnectionError
-from random import randint
-from time import sleep
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, MSG_DONTWAIT, SOL_SOCKET, SO_REUSEADDR, SO_KEEPALIVE, \
+    IPPROTO_TCP, TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT, TCP_USER_TIMEOUT, SHUT_RDWR, \
+    timeout as SocketConnectionError
+from threading import Event
+from asyncio import get_running_loop
+from select import select
+from time import perf_counter, monotonic
+from secrets import token_hex
+from typing import Optional
 
-from requests import post, get
 from agent_base import AgentBase
+from discovery import DiscoveryResponder
+from protocol import PROTOCOLS
+from utils.metrics import metrics
+from utils.log import get_logger
 from abc import ABCMeta
-from multiprocessing import Queue
 from utils.constants import SUCCESS, AUTHENTICATION_FAILURE, AGENT_CONNECTED
 
 
+logger = get_logger('lan_agent')
+
+
 class LAN_AgentMeta(ABCMeta):
     def __str__(self):
         return 'LAN'
@@ -17,90 +28,393 @@ class LAN_AgentMeta(ABCMeta):
 class LAN_Agent(AgentBase, metaclass=LAN_AgentMeta):
     """"""
 
+    PORT = 16000  # the clients find it with discovery.discover
+    ACK_WINDOW = 8  # maximum number of sent messages not yet acknowledged by the client
+    ACK_DELIMITER = b'\n'  # terminates every acknowledgement, see authenticate
+    RECEIVE_BUFFER_SIZE = 1024
+    DATAGRAM_OPTION = 'UDP'
+
+    receive_time = metrics.histogram('agent.receive')
+    received_bytes = metrics.counter('agent.received_bytes')
+
+    ACCEPT_TIMEOUT = 0.5  # seconds between the checks of the cancellation, while waiting for the client
+    LIVENESS_TIMEOUT = 5  # seconds without an answer from the client host, after which the connection is lost
+    RESUME_REQUEST = 'RESUME'
+
     @staticmethod
-    def poll(agent_queue: Queue) -> None:
-        try:
-            get("https://google.com/", timeout=3)
-            lan_agent_instance = LAN_Agent()
-            while lan_agent_instance.sending_socket is None or lan_agent_instance.receiving_socket is  None:
-                lan_agent_instance = LAN_Agent()
-
-            print("Creation of lan_agent was successful")
-            agent_queue.put(lan_agent_instance)
-            sleep(5)  # workaround: exiting this process closes the queue for some reason
-        except Exception as e:
-            # TODO: handle no internet (bluetooth)
-            print(f'Exception happened during get request:\n{e}')
-
-    def __init__(self):
-        """""" 
+    def poll(cancelled: Event) -> Optional['LAN_Agent']:
+        lan_agent_instance = LAN_Agent(cancelled=cancelled)
+        if lan_agent_instance.sending_socket is None:
+            lan_agent_instance.close_connection()
+            return None
+        logger.info("Creation of lan_agent was successful")
+        return lan_agent_instance
+
+    def __init__(self, port: Optional[int] = None, announce: bool = True, cancelled: Optional[Event] = None):
+        """
+        Listens on a port, and waits for the client to connect its receiving and sending sockets.
+
+        :param port: the port to listen on, PORT if None
+        :param announce: if True, the clients on the local network can discover the agent, until it is closed
+        :param cancelled: if it is set while waiting for the client, the sockets of the agent are left None
+        """
+        local_port = self.PORT if port is None else port
         conn = socket(AF_INET, SOCK_STREAM)
-        listening = False
+        conn.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)  # the port is free again right after a restart
+        conn.bind(('0.0.0.0', local_port))
+
+        self.discovery_responder = DiscoveryResponder(local_port) if announce else None
+        if self.discovery_responder is not None:
+            self.discovery_responder.start()
 
-        while not listening:
+        conn.listen()
+        conn.settimeout(self.ACCEPT_TIMEOUT if cancelled is not None else None)
+
+        self.receiving_socket = None
+        self.sending_socket = None
+        while self.sending_socket is None and not (cancelled is not None and cancelled.is_set()):
             try:
-                local_port = randint(15000, 60000)
-                receiving_address = ('0.0.0.0', local_port)
-                conn.bind(receiving_address)
-                listening = True
-            except OSError as error:
-                print(f"\r{error}", end='')
+                accepted, _ = conn.accept()
+                accepted.settimeout(None)
+                self.__keep_alive(accepted)
+                if self.receiving_socket is None:
+                    self.receiving_socket = accepted
+                else:
+                    self.sending_socket = accepted
+            except SocketConnectionError:
+                pass
 
-        post("https://kingbrady.web.elte.hu/rc_car/update.php", params={"ip": self.__get_IP(), "port": local_port})
+        self.listening_socket = conn  # kept open, so the client can reconnect and resume its session
+        self.session = None  # token of the session, the client can resume the session with it
 
-        conn.listen()
-        conn.setblocking(True)
+        self.local_port = local_port
+        self.datagram_socket = None
+        self.datagram_address = None
 
-        try:
-            self.receiving_socket, _ = conn.accept()
-            self.sending_socket, _ = conn.accept()
-        except SocketConnectionError:
-            pass
+        self.unacknowledged = 0
+        self.unterminated_acknowledgements = False  # warned about the client not terminating its acknowledgements
 
-        conn.close()
+        self.received = bytearray()
+        self.receive_buffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self.receive_view = memoryview(self.receive_buffer)
 
     def __str__(self):
         return 'LAN'
 
-    def __get_IP(self) -> str:
+    def close_connection(self) -> None:
+        if self.discovery_responder is not None:
+            self.discovery_responder.stop()
+        for sock in (self.sending_socket, self.receiving_socket, self.datagram_socket, self.listening_socket):
+            try:
+                if sock is not None:
+                    sock.close()
+            except OSError:
+                pass
+
+    def interrupt(self) -> None:
+        """
+        Shuts the receiving socket down, so the receiving side wakes up and waits for the client to resume the session.
         """
-        Querys the IP address, which the socket is bind to.
+        try:
+            self.receiving_socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    @classmethod
+    def __keep_alive(cls, sock: socket) -> None:
+        """
+        Probes the client host, while the connection is idle, and gives up on unacknowledged data, so a client which
+        disappeared without closing the connection (e.g. it lost the Wi-Fi) is detected in LIVENESS_TIMEOUT seconds,
+        the blocked receives and sends fail then.
 
         :Assumptions: None
 
-        :return: The IPV4 address, which the socket is bind to
+        :param sock: a connected TCP socket
+
+        :return: None
         """
-        s = socket(AF_INET, SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        IP = s.getsockname()[0]
-        s.close()
-        return IP
+        sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPIDLE, 1)
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPINTVL, 1)
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPCNT, cls.LIVENESS_TIMEOUT)
+        sock.setsockopt(IPPROTO_TCP, TCP_USER_TIMEOUT, cls.LIVENESS_TIMEOUT * 1000)
 
-    def close_connection(self) -> None:
-        try:
-            self.sending_socket.close()
-            self.receiving_socket.close()
-        except:
-            pass
+    def __open_datagram_channel(self) -> None:
+        """
+        Binds an UDP socket to the port of the agent. The client can send the commands in datagrams to it, and the
+        updates are sent back to the address the last datagram came from. Datagrams from other hosts are ignored.
+
+        :Assumptions: The client is authenticated
+
+        :return: None
+        """
+        self.datagram_socket = socket(AF_INET, SOCK_DGRAM)
+        self.datagram_socket.bind(('0.0.0.0', self.local_port))
 
     def authenticate(self, password: bytes) -> bool:
-        received_password = self.receiving_socket.recv(1024)
-        if password == received_password:
-            print('...GRANTED')
-            self.sending_socket.sendall('GRANTED\n'.encode())
+        """
+        Checks the password sent by the client. The password may be followed by space separated options:
+          * the name of the protocol the client wants to use (e.g. b'BINARY')
+          * b'UDP', if the client wants to send the commands and receive the updates in datagrams on the same port
+        The accepted options are appended to the GRANTED message, followed by SESSION:<token>, the token the client
+        can resume the session with, after its connection was lost.
+
+        After GRANTED, the client acknowledges every update received over TCP on the sending socket, with a newline
+        terminated acknowledgement (e.g. b'OK\\n'), so up to ACK_WINDOW updates can be in flight. Acknowledgements
+        without newline are still accepted, but as several of them can arrive in one chunk, a chunk without newline
+        only counts as one, and the updates are sent one per round trip to such clients.
+
+        :Assumptions: None
+
+        :param password: the expected password hash
+
+        :return: True if the client is authenticated, False otherwise
+        """
+        received = self.receiving_socket.recv(1024)
+        received_password, options = received[:len(password)], received[len(password):].decode(errors='replace').split()
+        valid_options = all(option in PROTOCOLS or option == self.DATAGRAM_OPTION for option in options)
+        if password == received_password and valid_options:
+            logger.info('...GRANTED')
+            for option in options:
+                if option == self.DATAGRAM_OPTION:
+                    self.__open_datagram_channel()
+                else:
+                    self.protocol = PROTOCOLS[option]
+            self.session = token_hex(16)
+            self.sending_socket.sendall((' '.join(['GRANTED', *options, f'SESSION:{self.session}']) + '\n').encode())
             return True
         else:
             # Should probably send rejected message to handle wrong password (like 3 times then give back controll)
-            print('...REJECTED')
+            logger.warning('...REJECTED')
             return False
 
-    def receive(self) -> str:
-        print('receiveing')
-        mes = self.receiving_socket.recv(1024).decode()
-        print(f'message received: {mes}')
-        return mes
+    def resume(self, timeout: float) -> bool:
+        """
+        Waits for the client to connect its receiving and sending sockets again, and to send 'RESUME <token>\\n' on
+        the receiving one, with the token received in the GRANTED message. The protocol and the datagram channel of the
+        session are kept, the updates are sent over TCP until the next datagram of the client arrives. Connections
+        with an invalid request are closed.
+
+        :Assumptions: The client is authenticated
+
+        :param timeout: seconds to wait for the client
+
+        :return: True if the session was resumed, the RESUMED message is sent to the client then
+        """
+        for sock in (self.receiving_socket, self.sending_socket):
+            sock.close()
+
+        expected = f'{self.RESUME_REQUEST} {self.session}'.encode()
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            receiving_socket = sending_socket = None
+            try:
+                self.listening_socket.settimeout(max(deadline - monotonic(), 0.001))
+                receiving_socket, _ = self.listening_socket.accept()
+                self.listening_socket.settimeout(max(deadline - monotonic(), 0.001))
+                sending_socket, _ = self.listening_socket.accept()
+                receiving_socket.settimeout(max(deadline - monotonic(), 0.001))
+                request, _, rest = receiving_socket.recv(self.RECEIVE_BUFFER_SIZE).partition(b'\n')
+            except OSError:
+                request = rest = b''
+
+            if self.session is not None and request.strip() == expected:
+                receiving_socket.settimeout(None)
+                sending_socket.settimeout(None)
+                self.__keep_alive(receiving_socket)
+                self.__keep_alive(sending_socket)
+                self.receiving_socket, self.sending_socket = receiving_socket, sending_socket
+                self.received = bytearray(rest)
+                self.unacknowledged = 0
+                self.datagram_address = None
+                self.sending_socket.sendall(b'RESUMED\n')
+                logger.info('session resumed')
+                return True
+
+            for sock in (receiving_socket, sending_socket):
+                if sock is not None:
+                    sock.close()
+
+        logger.info('session not resumed in %s s', timeout)
+        return False
+
+    def receive(self) -> list:
+        """
+        Reads from the socket until at least one complete message is received. Messages are delimited according to
+        the negotiated protocol, so a segment containing several messages, or only a part of one, is handled too.
+        If the datagram channel is open, every pending datagram is read as well, one message per datagram.
+
+        :Assumptions: None
+
+        :return: the received messages, an empty list if the client closed the connection, or it was lost
+        """
+        logger.debug('receiveing')
+        messages = self.protocol.split(self.received) if self.received else []  # left over from resume
+        while not messages:
+            if self.datagram_socket is not None:
+                readable, _, _ = select([self.receiving_socket, self.datagram_socket], [], [])
+            else:
+                readable = [self.receiving_socket]
+
+            messages = self.__read(readable)
+            if messages is None:
+                return []
+        logger.debug('messages received: %s', messages)
+        return messages
+
+    async def receive_async(self) -> list:
+        """
+        Same as receive, but waits for the sockets on the running event loop instead of blocking the thread.
+
+        :Assumptions: None
+
+        :return: the received messages, an empty list if the client closed the connection, or it was lost
+        """
+        sockets = [self.receiving_socket]
+        if self.datagram_socket is not None:
+            sockets.append(self.datagram_socket)
+        messages = self.protocol.split(self.received) if self.received else []  # left over from resume
+        while not messages:
+            readable = await self.__wait_readable(sockets)
+            messages = self.__read(readable)
+            if messages is None:
+                return []
+        logger.debug('messages received: %s', messages)
+        return messages
+
+    def __read(self, readable: list) -> Optional[list]:
+        """
+        Reads the messages from the sockets, which are ready to be read.
+
+        :Assumptions: None
+
+        :param readable: the sockets, which can be read without blocking
+
+        :return: the complete messages read, None if the client closed the connection, or it was lost
+        """
+        try:
+            return self.__read_ready(readable)
+        except OSError:
+            logger.info('connection lost')
+            return None
+
+    def __read_ready(self, readable: list) -> Optional[list]:
+        messages = []
+        if self.datagram_socket is not None and self.datagram_socket in readable:
+            started = perf_counter()
+            messages += self.__receive_datagrams()
+            self.receive_time.observe(perf_counter() - started)
+
+        if self.receiving_socket in readable:
+            size = self.receiving_socket.recv_into(self.receive_buffer)  # may wait for the data, if not selected
+            if not size:
+                return None
+            started = perf_counter()
+            self.received_bytes.increment(size)
+            self.received += self.receive_view[:size]
+            messages += self.protocol.split(self.received)
+            self.receive_time.observe(perf_counter() - started)
+
+        return messages
+
+    @staticmethod
+    async def __wait_readable(sockets: list) -> list:
+        """
+        Waits on the running event loop until one of the sockets can be read.
+
+        :Assumptions: None
+
+        :param sockets: the sockets to wait for
+
+        :return: a list containing the socket which became readable
+        """
+        loop = get_running_loop()
+        readable = loop.create_future()
+        for sock in sockets:
+            loop.add_reader(sock, lambda ready=sock: readable.done() or readable.set_result(ready))
 
-    def send(self, message: str) -> None:
-        print(f'message sent: {message}')
-        self.sending_socket.sendall(message.encode())
-        _ = self.sending_socket.recv(1024)
+        try:
+            return [await readable]
+        finally:
+            for sock in sockets:
+                loop.remove_reader(sock)
+
+    def __receive_datagrams(self) -> list:
+        """
+        Reads the pending datagrams without blocking.
+
+        :Assumptions: The datagram channel is open
+
+        :return: the messages received from the client
+        """
+        client_host = self.receiving_socket.getpeername()[0]
+        messages = []
+        while True:
+            try:
+                size, address = self.datagram_socket.recvfrom_into(self.receive_buffer, 0, MSG_DONTWAIT)
+            except BlockingIOError:
+                return messages
+
+            if address[0] == client_host:
+                self.received_bytes.increment(size)
+                self.datagram_address = address
+                messages.append(bytes(self.receive_view[:size]))
+
+    def send(self, message: bytes) -> None:
+        logger.debug('message sent: %s', message)
+        if self.datagram_address is not None:
+            self.datagram_socket.sendto(message, self.datagram_address)
+            return
+
+        self.sending_socket.sendall(message)
+        self.unacknowledged += 1
+        self.__receive_acknowledgements(block=self.unacknowledged >= self.ACK_WINDOW)
+
+    async def send_async(self, message: bytes) -> None:
+        """
+        Same as send, but waits for the socket and the acknowledgements on the running event loop.
+
+        :Assumptions: Only the asynchronous methods are used to send after the first call
+
+        :param message: the encoded message
+
+        :return: None
+        """
+        logger.debug('message sent: %s', message)
+        if self.datagram_address is not None:
+            self.datagram_socket.sendto(message, self.datagram_address)
+            return
+
+        self.sending_socket.setblocking(False)
+        await get_running_loop().sock_sendall(self.sending_socket, message)
+        self.unacknowledged += 1
+        if self.unacknowledged >= self.ACK_WINDOW:
+            await self.__wait_readable([self.sending_socket])
+        self.__receive_acknowledgements(block=False)
+
+    def __receive_acknowledgements(self, block: bool) -> None:
+        """
+        Consumes the acknowledgements sent by the client, so the sender only has to wait for the client, if
+        ACK_WINDOW messages are in flight. A newline terminated acknowledgement is expected for every message, a chunk
+        without newline is counted as one acknowledgement, which limits the client to one message per round trip.
+
+        :Assumptions: None
+
+        :param block: if True, waits until at least one acknowledgement arrives
+
+        :return: None
+        """
+        try:
+            acknowledgements = self.sending_socket.recv(1024, 0 if block else MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+
+        if acknowledgements:
+            terminated = acknowledgements.count(self.ACK_DELIMITER)
+            if not terminated and not self.unterminated_acknowledgements:
+                self.unterminated_acknowledgements = True
+                logger.warning('the acknowledgements of the client are not newline terminated, the updates are sent '
+                               'one per round trip')
+            self.unacknowledged = max(0, self.unacknowledged - max(1, terminated))
+        else:
+            self.unacknowledged = 0
@@ -1,110 +1,118 @@
 from utils.output_devices import LED
-from collections import defaultdict
+from utils.animation import Animation, AnimationEngine
+from utils.runtime import ThreadRuntime
 from utils.constants import *
+from utils.control_state import ControlState
+
+
+LIGHTS_BIT          = 0b0001
+HAZARD_WARNING_BIT  = 0b0010
+R_INDICATOR_BIT     = 0b0100
+L_INDICATOR_BIT     = 0b1000
+BITS                = ((LIGHTS, LIGHTS_BIT), (HAZARD_WARNING, HAZARD_WARNING_BIT), (R_INDICATOR, R_INDICATOR_BIT),
+                       (L_INDICATOR, L_INDICATOR_BIT))
+INPUTS              = 16  # number of the possible input bitmasks
+
+OUTPUTS = {  # state: the public states in it as a bitmask
+    LIGHTS_OFF: 0,
+    LIGHTS_ON: LIGHTS_BIT,
+    HAZARD_ON: LIGHTS_BIT | HAZARD_WARNING_BIT | R_INDICATOR_BIT | L_INDICATOR_BIT,
+    RIGHT_ON: LIGHTS_BIT | R_INDICATOR_BIT,
+    LEFT_ON: LIGHTS_BIT | L_INDICATOR_BIT,
+}
+
+
+def _next_state(state: int, inputs: int) -> int:
+    """
+    The rules of the lights, they are only evaluated to build the transition table.
+
+    :param state: the current state
+    :param inputs: bitmask of the user input
+
+    :return: the next state
+    """
+    lights, hazard_warning = inputs & LIGHTS_BIT, inputs & HAZARD_WARNING_BIT
+    right, left = inputs & R_INDICATOR_BIT, inputs & L_INDICATOR_BIT
+
+    if state == LIGHTS_OFF:
+        return LIGHTS_ON if lights else LIGHTS_OFF
+    if not lights:
+        return LIGHTS_OFF
+    if state == LIGHTS_ON:
+        return HAZARD_ON if hazard_warning else RIGHT_ON if right else LEFT_ON if left else LIGHTS_ON
+    if state == HAZARD_ON:
+        return HAZARD_ON if hazard_warning else LIGHTS_ON
+    if state == RIGHT_ON:
+        return HAZARD_ON if hazard_warning else LEFT_ON if left else RIGHT_ON if right else LIGHTS_ON
+    if state == LEFT_ON:
+        return HAZARD_ON if hazard_warning else RIGHT_ON if right else LEFT_ON if left else LIGHTS_ON
+
+
+# state * INPUTS + input bitmask -> (next state, bitmask of the public states in it)
+TRANSITIONS = [None] * (max(OUTPUTS) + 1) * INPUTS
+for _state in OUTPUTS:
+    for _inputs in range(INPUTS):
+        _next = _next_state(_state, _inputs)
+        TRANSITIONS[_state * INPUTS + _inputs] = (_next, OUTPUTS[_next])
 
 
 class Lights:
-
-    def __init__(self, front_lights_pin, back_lights_pin, left_indicator_pin, right_indicator_pin):
-        self.front_lights = [ LED(pin) for pin in front_lights_pin ]
-        self.back_lights = [ LED(pin) for pin in back_lights_pin ]
-        self.right_indicator = LED(right_indicator_pin)
-        self.left_indicator = LED(left_indicator_pin)
-
-        self.private_states = defaultdict(bool)
-        self.public_states = defaultdict(bool)
+    """
+    The lights of the car. Every command is a single lookup in the transition table, and the outputs changed by it
+    are found by comparing the output bitmasks. The public states are written to the shared state only when they
+    change.
+    """
+
+    def __init__(self, front_lights_pin, back_lights_pin, left_indicator_pin, right_indicator_pin, runtime=None,
+                 engine=None, states=None):
+        self.engine = engine or AnimationEngine()
+        if engine is None:
+            (runtime or ThreadRuntime()).start(self.engine.run())
+
+        self.front_lights = [ LED(pin, engine=self.engine) for pin in front_lights_pin ]
+        self.back_lights = [ LED(pin, engine=self.engine) for pin in back_lights_pin ]
+        self.right_indicator = LED(right_indicator_pin, engine=self.engine)
+        self.left_indicator = LED(left_indicator_pin, engine=self.engine)
+        self.indicator_animation = Animation.blink(self.engine.frame_rate, times=LED.INF, on_time=0.3, off_time=0,
+                                                   fade_in_time=0.5, fade_out_time=0.5)
 
         self.state = LIGHTS_OFF
+        self.outputs = OUTPUTS[LIGHTS_OFF]
+        self.states = states if states is not None else ControlState()  # only the fields in BITS are written
 
         self.breaking = False
 
     def handle_lights(self, data):
-        if self.state == LIGHTS_OFF:
-            if data[LIGHTS]:
-                self.__to_li_on()
-                self.__turn_lights_on()
-        elif not data[LIGHTS]:
-            self.__to_li_off()
-            self.__turn_lights_off()
-        elif self.state == LIGHTS_ON:
-            if data[HAZARD_WARNING]:
-                self.__to_ha_on()
-            elif data[R_INDICATOR]:
-                self.__to_ri_on()
-            elif data[L_INDICATOR]:
-                self.__to_le_on()
-        elif self.state == HAZARD_ON:
-            if not data[HAZARD_WARNING]:
-                self.__to_li_on()
-        elif self.state == RIGHT_ON:
-            if data[HAZARD_WARNING]:
-                self.__to_ha_on()
-            elif data[L_INDICATOR]:
-                self.__to_le_on()
-            elif not data[R_INDICATOR]:
-                self.__to_li_on()
-        elif self.state == LEFT_ON:
-            if data[HAZARD_WARNING]:
-                self.__to_ha_on()
-            elif data[R_INDICATOR]:
-                self.__to_ri_on()
-            elif not data[L_INDICATOR]:
-                self.__to_li_on()
-
-        if self.private_states[L_INDICATOR] != self.public_states[L_INDICATOR]:
-            self.__toggle_left_indicator()
-            self.private_states[L_INDICATOR] = self.public_states[L_INDICATOR]
-
-        if self.private_states[R_INDICATOR] != self.public_states[R_INDICATOR]:
-            self.__toggle_right_indicator()
-            self.private_states[R_INDICATOR] = self.public_states[R_INDICATOR]
-
-        if self.private_states[HAZARD_WARNING] != self.public_states[HAZARD_WARNING]:
-            self.__syncronize_indicators()
-            self.private_states[HAZARD_WARNING] = self.public_states[HAZARD_WARNING]
-
-        if self.state != LIGHTS_OFF and self.breaking != data['backward']:
-            for light in self.back_lights:
-                light.value = 1 if data['backward'] else 0.1  # TODO: constant
-            self.breaking = data['backward']
+        inputs = ((LIGHTS_BIT if data[LIGHTS] else 0) | (HAZARD_WARNING_BIT if data[HAZARD_WARNING] else 0) |
+                  (R_INDICATOR_BIT if data[R_INDICATOR] else 0) | (L_INDICATOR_BIT if data[L_INDICATOR] else 0))
+        self.state, outputs = TRANSITIONS[self.state * INPUTS + inputs]
+        changed = outputs ^ self.outputs
+        self.outputs = outputs
 
-    def get_data(self):
-        return self.public_states.items()
+        if changed:
+            for field, bit in BITS:
+                if changed & bit:
+                    self.states[field] = bool(outputs & bit)
 
-    def __to_li_off(self):
-        self.state = LIGHTS_OFF
-        self.public_states[LIGHTS] = False
-        self.public_states[HAZARD_WARNING] = False
-        self.public_states[R_INDICATOR] = False
-        self.public_states[L_INDICATOR] = False
-
-    def __to_li_on(self):
-        self.state = LIGHTS_ON
-        self.public_states[LIGHTS] = True
-        self.public_states[HAZARD_WARNING] = False
-        self.public_states[R_INDICATOR] = False
-        self.public_states[L_INDICATOR] = False
-
-    def __to_ri_on(self):
-        self.state = RIGHT_ON
-        self.public_states[LIGHTS] = True
-        self.public_states[HAZARD_WARNING] = False
-        self.public_states[R_INDICATOR] = True
-        self.public_states[L_INDICATOR] = False
-
-    def __to_le_on(self):
-        self.state = LEFT_ON
-        self.public_states[LIGHTS] = True
-        self.public_states[HAZARD_WARNING] = False
-        self.public_states[R_INDICATOR] = False
-        self.public_states[L_INDICATOR] = True
-
-    def __to_ha_on(self):
-        self.state = HAZARD_ON
-        self.public_states[LIGHTS] = True
-        self.public_states[HAZARD_WARNING] = True
-        self.public_states[R_INDICATOR] = True
-        self.public_states[L_INDICATOR] = True
+            if changed & LIGHTS_BIT:
+                if outputs & LIGHTS_BIT:
+                    self.__turn_lights_on()
+                else:
+                    self.__turn_lights_off()
+
+            if changed & L_INDICATOR_BIT:
+                self.__set_indicator(self.left_indicator, outputs & L_INDICATOR_BIT)
+
+            if changed & R_INDICATOR_BIT:
+                self.__set_indicator(self.right_indicator, outputs & R_INDICATOR_BIT)
+
+            if changed & outputs & HAZARD_WARNING_BIT:
+                self.engine.play([self.left_indicator, self.right_indicator], self.indicator_animation)  # in sync
+
+        if self.state != LIGHTS_OFF and self.breaking != data[BACKWARD]:
+            for light in self.back_lights:
+                light.value = 1 if data[BACKWARD] else 0.1  # TODO: constant
+            self.breaking = data[BACKWARD]
 
     def __turn_lights_on(self):
         for light in self.front_lights:
@@ -118,21 +126,8 @@ class Lights:
         for light in [*self.front_lights, *self.back_lights]:
             light.off()
 
-    def __toggle_left_indicator(self):
-        if self.private_states[L_INDICATOR]:
-            self.left_indicator.off()
-        else:
-            self.left_indicator.blink(times=LED.INF, on_time=0.3, off_time=0, fade_in_time=0.5, fade_out_time=0.5, non_blocking=True)
-
-    def __toggle_right_indicator(self):
-        if self.private_states[R_INDICATOR]:
-            self.right_indicator.off()
+    def __set_indicator(self, indicator, on):
+        if on:
+            self.engine.play([indicator], self.indicator_animation)
         else:
-            self.right_indicator.blink(times=LED.INF, on_time=0.3, off_time=0, fade_in_time=0.5, fade_out_time=0.5, non_blocking=True)
-
-    def __syncronize_indicators(self):
-        if not self.private_states[HAZARD_WARNING]:
-            self.right_indicator.off()
-            self.left_indicator.off()
-            self.right_indicator.blink(times=LED.INF, on_time=0.3, off_time=0, fade_in_time=0.5, fade_out_time=0.5, non_blocking=True)
-            self.left_indicator.blink(times=LED.INF, on_time=0.3, off_time=0, fade_in_time=0.5, fade_out_time=0.5, non_blocking=True)
+            indicator.off()
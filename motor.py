@@ -1,8 +1,12 @@
-from gpiozero import Motor as Wheel
-from threading import Thread
-from time import sleep
-from collections import defaultdict
+from math import isfinite
+from typing import Iterator
 from utils.constants import * 
+from utils.control_state import ControlState
+from utils.runtime import ThreadRuntime
+from utils.backend import get_backend
+from utils.log import get_logger
+
+logger = get_logger('motor')
 
 # TODO: refactor contained + distance keeping
 
@@ -15,9 +19,17 @@ class Motor:
     MAX_DISTANCE        = 20
     TURN_DIRECTION      = RIGHT
 
-    def __init__(self, right_wheel_pins, left_wheel_pins):
-        self.right_wheel = Wheel(*right_wheel_pins)
-        self.left_wheel = Wheel(*left_wheel_pins)
+    SPEED_WORKER        = 'speed'  # accelerating and breaking replace each other
+    MODE_WORKER         = 'mode'   # distance keeping, line following, keeping contained
+
+    STATE_FIELDS        = (FORWARD, BACKWARD, LEFT, RIGHT, REVERSE, DISTANCE_KEEPING, LINE_FOLLOWING, KEEP_CONTAINED)
+
+    def __init__(self, right_wheel_pins, left_wheel_pins, runtime=None, distance_sampler=None, states=None):
+        self.runtime = runtime or ThreadRuntime()
+        self.distance_sampler = distance_sampler
+
+        self.right_wheel = get_backend().wheel(*right_wheel_pins)
+        self.left_wheel = get_backend().wheel(*left_wheel_pins)
 
         self.state = STOP
         self.direcion = FORWARD
@@ -31,30 +43,33 @@ class Motor:
         self.following_line = False
         self.keep_contained = False
 
-        self.distance = 100.0
+        self._distance = 100.0
         self.distance_state = STOP
 
         self.line_detected = False
         self.contain_state = STOP
 
-        self.states = defaultdict(bool)
+        self.throttle = 0.0
+        self.steering = 0.0
+
+        self.states = states if states is not None else ControlState()  # only the STATE_FIELDS are written
 
     def handle_motor_control(self, data):
         if data[DISTANCE_KEEPING]:
             if self.state == STOP:
                 self.keeping_distance = True
                 self.states[DISTANCE_KEEPING] = True
-                Thread(target=self.__keep_distance).start()
+                self.runtime.start(self.__keep_distance(), self.MODE_WORKER)
         elif data[LINE_FOLLOWING]:
             if self.state == STOP:
                 self.following_line = True
                 self.states[LINE_FOLLOWING] = True
-                Thread(target=self.__follow_line).start()
+                self.runtime.start(self.__follow_line(), self.MODE_WORKER)
         elif data[KEEP_CONTAINED]:
             if self.state == STOP:
                 self.keep_contained = True
                 self.states[KEEP_CONTAINED] = True
-                Thread(target=self.__keep_contained).start()
+                self.runtime.start(self.__keep_contained(), self.MODE_WORKER)
         elif self.state in [DISTANCE_STATE, LINE_STATE, CONTAIN_STATE]:
             self.states[DISTANCE_KEEPING] = False
             self.states[LINE_FOLLOWING] = False
@@ -62,17 +77,62 @@ class Motor:
             self.keeping_distance = False
             self.following_line = False
             self.keep_contained = False
+        elif THROTTLE in data or STEERING in data:
+            self.__handle_analog(data)
         else:
+            if self.state == ANALOG_STATE:
+                self.__stop()
             self.__handle_speed(data)
             self.__handle_directions(data)
 
         if data[CHANGE_DIRECTION]:
             self.TURN_DIRECTION = RIGHT if self.TURN_DIRECTION == LEFT else LEFT
 
-    def get_data(self):
-        return self.states.items()
-
-    def __keep_distance(self):
+    def stop(self):
+        """Leaves every driving mode, and stops the wheels immediately"""
+        self.keeping_distance = False
+        self.following_line = False
+        self.keep_contained = False
+        self.can_accelerate = False
+        self.can_break = False
+        self.runtime.cancel(self.MODE_WORKER)
+        self.__stop()
+        with self.states:
+            for key in self.STATE_FIELDS:
+                self.states[key] = False
+
+    def brake(self):
+        """
+        Leaves every driving mode, and slows down to a stop with the breaking ramp, if the car is accelerating, otherwise
+        stops the wheels immediately. The next command takes over the control again.
+        """
+        self.keeping_distance = False
+        self.following_line = False
+        self.keep_contained = False
+        self.runtime.cancel(self.MODE_WORKER)
+        with self.states:
+            for key in (FORWARD, BACKWARD, LEFT, RIGHT, DISTANCE_KEEPING, LINE_FOLLOWING, KEEP_CONTAINED):
+                self.states[key] = False
+
+        if self.state == ACCELERATING:
+            self.can_accelerate = False
+            self.can_break = True
+            self.runtime.start(self.__break(), self.SPEED_WORKER)
+        elif self.state != BREAKING:
+            self.__stop()
+
+    @property
+    def distance(self):
+        """The latest filtered reading of the distance sampler, if there is one, otherwise the value set last"""
+        if self.distance_sampler is not None:
+            return self.distance_sampler.value
+        return self._distance
+
+    @distance.setter
+    def distance(self, value):
+        self._distance = value
+
+    def __keep_distance(self) -> Iterator[float]:
         self.state = DISTANCE_STATE
         self.states[REVERSE] = False
         right_turn = self.TURN_DIRECTION == RIGHT
@@ -94,7 +154,7 @@ class Motor:
             self.states[FORWARD] = True
 
         while self.keeping_distance:
-            sleep(0.05)
+            yield 0.05
             if self.distance_state == ACCELERATING and self.distance < self.MAX_DISTANCE:
                 self.right_wheel.stop()
                 self.left_wheel.stop()
@@ -102,7 +162,7 @@ class Motor:
                 self.distance_state = STOP
                 self.states[FORWARD] = False
 
-                sleep(0.5)
+                yield 0.5
 
                 if right_turn:
                     self.left_wheel.forward(self.TURN_FORWARD_SPEED)
@@ -117,7 +177,7 @@ class Motor:
                 self.left_wheel.stop()
                 self.states[self.TURN_DIRECTION] = False
                 
-                sleep(0.5)
+                yield 0.5
 
                 self.distance_state = ACCELERATING
                 self.right_wheel.forward(self.CONTAIN_SPEED)
@@ -125,22 +185,23 @@ class Motor:
                 self.current_speed = self.CONTAIN_SPEED
                 self.states[FORWARD] = True
 
-        self.states[FORWARD] = False
-        self.states[self.TURN_DIRECTION] = False
+        with self.states:
+            self.states[FORWARD] = False
+            self.states[self.TURN_DIRECTION] = False
         self.state = STOP
         self.left_wheel.stop()
         self.right_wheel.stop()
         self.current_speed = 0
 
-    def __follow_line(self):
+    def __follow_line(self) -> Iterator[float]:
         self.state = LINE_STATE
         while self.following_line:
-            print(f"Following Line: {self.line_detected}")
-            sleep(0.5)
-        print('Not Following Line Anymore..')
+            logger.debug("Following Line: %s", self.line_detected)
+            yield 0.5
+        logger.info('Not Following Line Anymore..')
         self.__stop()
 
-    def __keep_contained(self):
+    def __keep_contained(self) -> Iterator[float]:
         self.state = CONTAIN_STATE
         self.states[REVERSE] = False
         right_turn = self.TURN_DIRECTION == RIGHT
@@ -154,7 +215,7 @@ class Motor:
                 self.right_wheel.forward(self.TURN_FORWARD_SPEED)
                 self.left_wheel.backward(self.TURN_BACKWARD_SPEED)
             self.states[self.TURN_DIRECTION] = True
-            sleep(2.5)
+            yield 2.5
         else:
             self.contain_state = ACCELERATING
             self.right_wheel.forward(self.CONTAIN_SPEED)
@@ -163,7 +224,7 @@ class Motor:
             self.states[FORWARD] = True
 
         while self.keep_contained:
-            sleep(0.05)
+            yield 0.05
             if self.line_detected:
                 self.right_wheel.stop()
                 self.left_wheel.stop()
@@ -171,7 +232,7 @@ class Motor:
                 self.contain_state = STOP
                 self.states[FORWARD] = False
 
-                sleep(0.5)
+                yield 0.5
 
                 if right_turn:
                     self.left_wheel.forward(self.TURN_FORWARD_SPEED)
@@ -181,14 +242,14 @@ class Motor:
                     self.left_wheel.backward(self.TURN_BACKWARD_SPEED)
                 self.states[self.TURN_DIRECTION] = True
 
-                sleep(2.5)
+                yield 2.5
 
             elif self.contain_state == STOP and not self.line_detected:
                 self.right_wheel.stop()
                 self.left_wheel.stop()
                 self.states[self.TURN_DIRECTION] = False
                 
-                sleep(0.5)
+                yield 0.5
 
                 self.contain_state = ACCELERATING
                 self.right_wheel.forward(self.CONTAIN_SPEED)
@@ -196,8 +257,9 @@ class Motor:
                 self.current_speed = self.CONTAIN_SPEED
                 self.states[FORWARD] = True
 
-        self.states[FORWARD] = False
-        self.states[self.TURN_DIRECTION] = False
+        with self.states:
+            self.states[FORWARD] = False
+            self.states[self.TURN_DIRECTION] = False
         self.state = STOP
         self.left_wheel.stop()
         self.right_wheel.stop()
@@ -214,7 +276,7 @@ class Motor:
                     self.states[FORWARD] = True
                     self.states[BACKWARD] = False
                     self.can_accelerate = True
-                    Thread(target=self.__acc).start()
+                    self.runtime.start(self.__acc(), self.SPEED_WORKER)
                 else:
                     self.states[BACKWARD] = False
             elif self.state in [ACCELERATING, DISTANCE_STATE, LINE_STATE]:
@@ -227,7 +289,7 @@ class Motor:
                     self.states[FORWARD] = False
                     self.can_accelerate = False
                     self.can_break = True
-                    Thread(target=self.__break).start()
+                    self.runtime.start(self.__break(), self.SPEED_WORKER)
             elif self.state == BREAKING:
                 if data[BACKWARD]:
                     self.states[BACKWARD] = True
@@ -237,7 +299,7 @@ class Motor:
                     self.states[FORWARD] = True
                     self.can_break = False
                     self.can_accelerate = True
-                    Thread(target=self.__acc).start()
+                    self.runtime.start(self.__acc(), self.SPEED_WORKER)
 
     def __handle_directions(self, data):
         if self.state in [STOP, DISTANCE_STATE, LINE_STATE]:
@@ -265,7 +327,60 @@ class Motor:
                     else:
                         self.__stop()
 
-    def __acc(self):
+    def __handle_analog(self, data):
+        """
+        Sets the throttle and the steering of the analog control mode. The wheels are driven by the __drive behaviour
+        from the next control tick, or stopped immediately, if both are 0. With reverse on, the throttle drives the
+        wheels the other way, like the forward and backward buttons do. Raises ValueError for values, which are not
+        finite numbers (e.g. NaN), before changing anything.
+        """
+        throttle, steering = float(data[THROTTLE]), float(data[STEERING])
+        if not (isfinite(throttle) and isfinite(steering)):
+            raise ValueError(f'throttle and steering have to be finite: {throttle}, {steering}')
+
+        self.throttle = max(-1.0, min(1.0, throttle))
+        self.steering = max(-1.0, min(1.0, steering))
+
+        self.states[FORWARD] = self.throttle > 0
+        self.states[BACKWARD] = self.throttle < 0
+        self.states[LEFT] = self.steering < 0
+        self.states[RIGHT] = self.steering > 0
+        self.states[REVERSE] = bool(data[REVERSE])
+
+        if self.throttle == 0 and self.steering == 0:
+            if self.state == ANALOG_STATE:
+                self.__stop()
+        elif self.state != ANALOG_STATE:
+            self.__stop()
+            self.state = ANALOG_STATE
+            self.runtime.start(self.__drive(), self.SPEED_WORKER)
+
+    def __drive(self) -> Iterator[float]:
+        """
+        Maps the throttle and the steering to the speeds of the wheels on every tick: the steering is added to the
+        speed of the outer wheel and subtracted from the inner one, both are scaled down, if either exceeds 1.
+        """
+        while True:
+            throttle = -self.throttle if self.states[REVERSE] else self.throttle
+            left = throttle + self.steering
+            right = throttle - self.steering
+            divisor = max(1.0, abs(left), abs(right))
+
+            self.__set_wheel_speed(self.left_wheel, left / divisor * self.MAX_SPEED)  # unchanged speeds are not written
+            self.__set_wheel_speed(self.right_wheel, right / divisor * self.MAX_SPEED)
+            self.current_speed = abs(self.throttle) * self.MAX_SPEED
+            yield 0  # the next tick
+
+    @staticmethod
+    def __set_wheel_speed(wheel, speed):
+        if speed > 0:
+            wheel.forward(speed)
+        elif speed < 0:
+            wheel.backward(-speed)
+        else:
+            wheel.stop()
+
+    def __acc(self) -> Iterator[float]:
         self.state = ACCELERATING
 
         if self.current_speed < 0.2:
@@ -278,10 +393,10 @@ class Motor:
             else:
                 self.right_wheel.backward(self.current_speed)
                 self.left_wheel.backward(self.current_speed)
-            sleep(0.1)
+            yield 0.1
             self.current_speed += 0.05
 
-    def __break(self):
+    def __break(self) -> Iterator[float]:
         self.state = BREAKING
 
         while self.can_break and self.current_speed > 0.2:
@@ -292,7 +407,7 @@ class Motor:
             else:
                 self.right_wheel.backward(self.current_speed)
                 self.left_wheel.backward(self.current_speed)
-            sleep(0.1)
+            yield 0.1
 
         if self.can_break:
             self.right_wheel.stop()
@@ -310,6 +425,7 @@ class Motor:
             self.left_wheel.backward(self.TURN_BACKWARD_SPEED)
 
     def __stop(self):
+        self.runtime.cancel(self.SPEED_WORKER)
         self.state = STOP
         self.direcion = FORWARD
         self.left_wheel.stop()
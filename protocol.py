@@ -0,0 +1,176 @@
+from abc import ABC, ABCMeta
+from json import dumps, loads
+from struct import Struct
+
+from utils.constants import BOOLEAN_FIELDS, NUMERIC_FIELDS, SEQUENCE, KEYFRAME
+
+
+class Protocol(ABC, metaclass=ABCMeta):
+    """
+    Wire format of the commands received from, and the updates sent to the client.
+
+    Every command contains the whole user input. The client has to repeat its command at least every 0.5 seconds
+    (Watchdog.TIMEOUT), even if the input did not change, otherwise the car brakes, as if the client was lost. For
+    clients, which only send on change, the car can be started with --command-timeout <seconds>, or with
+    --command-timeout off to disable the watchdog.
+    """
+
+    NAME = ''
+
+    def encode(self, values: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, message: bytes) -> dict:
+        raise NotImplementedError
+
+    def split(self, buffer: bytearray) -> list:
+        """
+        Removes the complete messages from the beginning of the buffer.
+
+        :Assumptions: None
+
+        :param buffer: the received bytes, an incomplete message is left in it
+
+        :return: the complete messages in the order they were received
+        """
+        raise NotImplementedError
+
+
+class JsonProtocol(Protocol):
+    """
+    The default protocol: every message is a newline terminated JSON object.
+
+    :examples:
+    >>> JsonProtocol().encode({'forward': True})
+    b'{"forward": true}\\n'
+    """
+
+    NAME = 'JSON'
+
+    def encode(self, values: dict) -> bytes:
+        return (dumps(values) + '\n').encode()
+
+    def decode(self, message: bytes) -> dict:
+        return loads(message)
+
+    def split(self, buffer: bytearray) -> list:
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            return []
+
+        messages = bytes(buffer[:end]).split(b'\n')
+        del buffer[:end + 1]
+        return [message for message in messages if message.strip()]
+
+
+class BinaryProtocol(Protocol):
+    """
+    Compact protocol, which can be requested by the client during authentication.
+
+    Layout of a message (little endian):
+      * 1 byte: length of the rest of the message
+      * 1 byte: flags, bit 0: keyframe, bit 1: sequence number is valid, bit 2+i: i-th numeric field is present
+      * 4 bytes: sequence number
+      * 2 bytes: bitmask of the boolean fields present in the message
+      * 2 bytes: bitmask of the values of the boolean fields
+      * 4 bytes for every present numeric field, as float
+
+    The order of the fields is defined by BOOLEAN_FIELDS and NUMERIC_FIELDS in utils.constants
+
+    :examples:
+    >>> protocol = BinaryProtocol()
+    >>> protocol.decode(protocol.encode({'forward': True, 'distance': 12.5}))
+    {'forward': True, 'distance': 12.5}
+    """
+
+    NAME = 'BINARY'
+
+    HEADER = Struct('<BBIHH')
+    NUMBER = Struct('<f')
+
+    KEYFRAME_FLAG = 0b01
+    SEQUENCE_FLAG = 0b10
+
+    BOOLEAN_BITS = {field: 1 << index for index, field in enumerate(BOOLEAN_FIELDS)}
+    NUMERIC_BITS = {field: 1 << index for index, field in enumerate(NUMERIC_FIELDS, start=2)}
+
+    def encode(self, values: dict) -> bytes:
+        flags = 0
+        present = 0
+        mask = 0
+        numbers = b''
+
+        if SEQUENCE in values:
+            flags |= self.SEQUENCE_FLAG
+            if values.get(KEYFRAME):
+                flags |= self.KEYFRAME_FLAG
+
+        for field, bit in self.BOOLEAN_BITS.items():
+            if field in values:
+                present |= bit
+                if values[field]:
+                    mask |= bit
+
+        for field, bit in self.NUMERIC_BITS.items():
+            if field in values:
+                flags |= bit
+                numbers += self.NUMBER.pack(values[field])
+
+        length = self.HEADER.size - 1 + len(numbers)
+        return self.HEADER.pack(length, flags, values.get(SEQUENCE, 0), present, mask) + numbers
+
+    def decode(self, message: bytes) -> dict:
+        _, flags, sequence, present, mask = self.HEADER.unpack_from(message)
+        values = dict()
+
+        if flags & self.SEQUENCE_FLAG:
+            values[SEQUENCE] = sequence
+            values[KEYFRAME] = bool(flags & self.KEYFRAME_FLAG)
+
+        for field, bit in self.BOOLEAN_BITS.items():
+            if present & bit:
+                values[field] = bool(mask & bit)
+
+        offset = self.HEADER.size
+        for field, bit in self.NUMERIC_BITS.items():
+            if flags & bit:
+                values[field] = self.NUMBER.unpack_from(message, offset)[0]
+                offset += self.NUMBER.size
+
+        return values
+
+    def split(self, buffer: bytearray) -> list:
+        messages = []
+        offset = 0
+        while offset < len(buffer) and offset + buffer[offset] < len(buffer):
+            end = offset + buffer[offset] + 1
+            messages.append(bytes(buffer[offset:end]))
+            offset = end
+
+        del buffer[:offset]
+        return messages
+
+
+class LocalProtocol(Protocol):
+    """
+    Protocol of the agents reading a local input device: their messages are already decoded commands, and the updates
+    are passed to them as they are. It can not be negotiated by a remote client, so it is not in PROTOCOLS.
+
+    :examples:
+    >>> LocalProtocol().decode({'forward': True})
+    {'forward': True}
+    """
+
+    NAME = 'LOCAL'
+
+    def encode(self, values: dict) -> dict:
+        return values
+
+    def decode(self, message: dict) -> dict:
+        return message
+
+    def split(self, buffer: bytearray) -> list:
+        raise NotImplementedError  # the messages are not read from a byte stream
+
+
+PROTOCOLS = {protocol.NAME: protocol for protocol in (JsonProtocol(), BinaryProtocol())}
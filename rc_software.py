@@ -1,95 +1,261 @@
-from multiprocessing import Process, Queue
-from json import dumps, loads
-from threading import Thread
+from threading import Thread, Event, active_count
+from asyncio import run as run_event_loop, gather, get_running_loop, sleep as async_sleep
 
 from controller import Controller
+from telemetry import DeltaEncoder
 from lan_agent import LAN_Agent
 from bluetooth_agent import BluetoothAgent
 from ds4_agent import DS4Agent
 from agent_base import AgentBase
+from connection_manager import ConnectionManager
 from hashlib import sha256
-from utils.constants import SUCCESS, AUTHENTICATION_FAILURE, AGENT_CONNECTED
+from utils.constants import SUCCESS, AUTHENTICATION_FAILURE, AGENT_CONNECTED, SEQUENCE
+from utils.runtime import ThreadRuntime, AsyncioRuntime
+from utils.control_loop import ControlLoop
+from utils.watchdog import Watchdog
+from utils.backend import set_backend, SimulatedBackend
+from utils.metrics import metrics
+from utils.log import get_logger, setup_logging
 
 from sys import argv
-from time import sleep
+from time import sleep, perf_counter
+from struct import error as StructError
+from typing import Optional
+from logging import DEBUG, INFO
+
+logger = get_logger('rc_software')
 
 
 class RC_Car:
     """
     The entrypoint of the software for the RC car created like this: TODO: link
-    By default it will listen on an available port in a range 8000, 60000
+    By default the LAN agent listens on port LAN_Agent.PORT, the clients on the local network can discover it with
+    discovery.discover
 
     :examples:
 
     >>> car = RC_Car()
     >>> car.run()
+    >>> car = RC_Car(delta_telemetry=True)  # only send the changed values to the client
+    >>> car.run()
+    >>> car = RC_Car(asynchronous=True)  # run everything on a single asyncio event loop
+    >>> car.run()
     """
-    def __init__(self):
+
+    UPDATE_PERIOD = 0.05
+    METRICS_LOG_PERIOD = 10
+    METRICS_WORKER = 'metrics'
+    SESSION_GRACE = 10  # seconds the client has to resume its session after the connection was lost
+    WATCHDOG_WORKER = 'watchdog'
+    AGENT_TYPES = (LAN_Agent, BluetoothAgent, DS4Agent)  # polled at the same time, the first authenticated one wins
+
+    def __init__(self, delta_telemetry: bool = False, asynchronous: bool = False, agent: AgentBase = None,
+                 metrics_port: Optional[int] = None, session_grace: float = SESSION_GRACE,
+                 command_timeout: Optional[float] = Watchdog.TIMEOUT):
         """
         Creates the instance of the RC_Car class. 
-          * Starts to listen, on a free port in range 8000, 60000,
-          * If a connection request received it establishes the connection with the client. 
+          * Polls every type of agent at the same time, until a client connects and authenticates
+          * The polling of the other agents is cancelled
           * Creates the instance of the controller class
 
         :Assumptions:
           * Only one instance of the class is created
+
+        :param delta_telemetry: if True, the updates only contain the values changed since the previous update,
+            a sequence number, and a full keyframe periodically
+        :param asynchronous: if True, the agent I/O, the updates, and the background behaviours of the motor and the
+            lights run as coroutines on one event loop, instead of in separate threads
+        :param agent: an already connected agent, no agents are polled, unless it fails to authenticate
+        :param metrics_port: if set, the metrics are served on http://127.0.0.1:metrics_port/metrics, and logged
+            periodically
+        :param session_grace: seconds the client has to reconnect and resume its session, after the connection was
+            lost, the car keeps its state in the meantime
+        :param command_timeout: seconds without a valid command, after which the car brakes, the client has to repeat
+            its command more often, even if it did not change, the watchdog is disabled if None
         """
         self.agent: AgentBase = None
-        self.agent_queue: "Queue[AgentBase]" = Queue()
-        self.poll_processes = dict()
+        self.telemetry_encoder = DeltaEncoder() if delta_telemetry else None
+        self.asynchronous = asynchronous
+        self.runtime = AsyncioRuntime() if asynchronous else ThreadRuntime()
+        self.control_loop = ControlLoop()
+        self.metrics_port = metrics_port
+        self.session_grace = session_grace
+        self.link_up = Event()  # cleared while the agent waits for the client to resume the session
+
+        self.received_commands = metrics.counter('commands.received')
+        self.dropped_commands = metrics.counter('commands.dropped')
+        self.parse_time = metrics.histogram('commands.parse')
+        self.set_values_time = metrics.histogram('controller.set_values')
+        self.get_values_time = metrics.histogram('controller.get_values')
+        self.send_time = metrics.histogram('updates.send')
+        metrics.gauge('threads', active_count)
+        metrics.gauge('runtime.workers', lambda: self.runtime.live)
+        self.resumed_sessions = metrics.counter('sessions.resumed')
+        self.lost_sessions = metrics.counter('sessions.lost')
 
         password = "69420"  # TODO: get password from file
         self.password = sha256(password.encode()).digest()
 
-        # self.poll_processes[str(LAN_Agent)] = Process(target=LAN_Agent.poll, args=(self.agent_queue,))
-        self.poll_processes[str(DS4Agent)] = Process(target=DS4Agent.poll, args=(self.agent_queue,))
-        # self.poll_processes[str(LAN_Agent)].start()
-        self.poll_processes[str(DS4Agent)].start()
-
-        while not self.agent:
-            print('before get')
-            candidate_agent = self.agent_queue.get()
-            print('after get')
-            if candidate_agent.authenticate(self.password):
-                self.agent = candidate_agent
-                self.controller = Controller()
-                self.is_connection_alive = True
-                for process in self.poll_processes.values():
-                    process.terminate()
-            else:
-                candidate_agent.close_connection()
-                self.poll_processes[str(candidate_agent)] = Process(target=type(candidate_agent).poll, args=(self.agent_queue,))
-                self.poll_processes[str(candidate_agent)].start()
+        self.connection_manager = ConnectionManager(self.password, self.AGENT_TYPES)
+        self.agent = self.connection_manager.connect(agent)
+        self.controller = Controller(runtime=self.runtime, control_loop=self.control_loop)
+        self.values = dict()  # the snapshot of the state, refilled for every update
+        self.watchdog = Watchdog(command_timeout, self.controller.brake) if command_timeout is not None else None
+        self.is_connection_alive = True
+        self.link_up.set()
+        self.last_command_sequence = -1
 
     def run(self) -> None:
         """
           * Starts the thread which sends updates on the state of the controller
           * Starts the method which is responsible for receiving the commands from the client.
 
-          Note: It blocks until the the client ends connection.
+          * Starts the control loop, which drives the motor
+
+          In asynchronous mode all of them are coroutines on a new event loop instead.
+
+          Note: It blocks until the the client ends connection, and does not resume its session in time.
 
           :return: None
         """
+        if self.asynchronous:
+            run_event_loop(self.__run_async())
+            return
+
+        self.__start_background()
         update_thread = Thread(target=self.send_updates)
         update_thread.start()
         self.receive_commands()
         update_thread.join()
+        self.__stop_background()
+
+    async def __run_async(self) -> None:
+        self.runtime.loop = get_running_loop()
+        self.__start_background()
+        await gather(self.receive_commands_async(), self.send_updates_async())
+        self.__stop_background()
+
+    def __start_background(self) -> None:
+        self.runtime.start(self.control_loop.run())
+        if self.watchdog is not None:
+            self.watchdog.feed()
+            self.control_loop.start(self.watchdog.run(), self.WATCHDOG_WORKER)
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.serve(self.metrics_port)
+            self.runtime.start(metrics.log_snapshots(self.METRICS_LOG_PERIOD), self.METRICS_WORKER)
+
+    def __stop_background(self) -> None:
+        self.control_loop.cancel(self.WATCHDOG_WORKER)
+        self.controller.close()
+        self.control_loop.stop()
+        if self.metrics_port is not None:
+            self.runtime.cancel(self.METRICS_WORKER)
+            self.metrics_server.shutdown()
         
     def receive_commands(self) -> None:
         """
-        Listens on the receiving socket in an infinite loop.
+        Listens on the receiving socket in an infinite loop. If multiple commands arrive at once, only the latest one
+        is applied. Commands carrying a sequence number older than the last applied one are dropped. If the connection
+        is lost, the client has session_grace seconds to resume its session.
 
         :Assumpitons: None
 
         :return: None
         """
         while True:
-            data = self.agent.receive()
-            if not data:
-                self.is_connection_alive = False
-                break
+            messages = self.agent.receive()
+            if not messages:
+                self.link_up.clear()
+                if not self.__resumed(self.agent.resume(self.session_grace)):
+                    break
             else:
-                self.controller.set_values(loads(data))
+                self.received_commands.increment(len(messages))
+                self.dropped_commands.increment(len(messages) - 1)
+                self.__apply_command(messages[-1])
+
+    async def receive_commands_async(self) -> None:
+        """
+        Same as receive_commands, but waits for the commands on the running event loop.
+
+        :Assumpitons: None
+
+        :return: None
+        """
+        while True:
+            messages = await self.agent.receive_async()
+            if not messages:
+                self.link_up.clear()
+                resumed = await get_running_loop().run_in_executor(None, self.agent.resume, self.session_grace)
+                if not self.__resumed(resumed):
+                    break
+            else:
+                self.received_commands.increment(len(messages))
+                self.dropped_commands.increment(len(messages) - 1)
+                self.__apply_command(messages[-1])
+
+    def __resumed(self, resumed: bool) -> bool:
+        """
+        Continues the session resumed by the client, or ends the connection.
+
+        :Assumptions: The link is down
+
+        :param resumed: whether the client resumed its session
+
+        :return: resumed
+        """
+        if resumed:
+            self.resumed_sessions.increment()
+            self.last_command_sequence = -1  # the sequence numbers of the resumed connection may start over
+            if self.telemetry_encoder is not None:
+                self.telemetry_encoder.request_keyframe()
+            self.link_up.set()
+        else:
+            self.lost_sessions.increment()
+            self.is_connection_alive = False
+        return resumed
+
+    def __apply_command(self, message: bytes) -> None:
+        """
+        Decodes the command and passes it to the controller, unless a newer one was already applied.
+
+        :Assumpitons: None
+
+        :param message: the latest received message, every command contains the whole user input, so the earlier
+            ones are already outdated, malformed messages are dropped
+
+        :return: None
+        """
+        started = perf_counter()
+        try:
+            command = self.agent.protocol.decode(message)
+            if not isinstance(command, dict):
+                raise TypeError('the command is not an object')
+            outdated = SEQUENCE in command and command[SEQUENCE] <= self.last_command_sequence
+        except (ValueError, TypeError, AttributeError, StructError) as error:
+            self.__drop_malformed(message, error)
+            return
+        self.parse_time.observe(perf_counter() - started)
+
+        if outdated:
+            self.dropped_commands.increment()
+            return  # reordered datagram, a newer command was already applied
+        if SEQUENCE in command:
+            self.last_command_sequence = command[SEQUENCE]
+
+        if self.watchdog is not None:
+            self.watchdog.feed()
+
+        started = perf_counter()
+        try:
+            self.controller.set_values(command)
+        except (ValueError, TypeError, AttributeError) as error:  # e.g. a throttle, which is not a number
+            self.__drop_malformed(message, error)
+            return
+        self.set_values_time.observe(perf_counter() - started)
+
+    def __drop_malformed(self, message: bytes, error: Exception) -> None:
+        self.dropped_commands.increment()
+        logger.warning('malformed command dropped: %r (%s)', message, error)
 
     def send_updates(self) -> None:
         """
@@ -100,13 +266,60 @@ class RC_Car:
         :return: None
         """
         while self.is_connection_alive:
-            message = dumps(self.controller.get_values()) + '\n'
-            self.agent.send(message)
-            sleep(0.05) # distance sensor
+            if self.link_up.is_set():
+                update = self.__next_update()
+                started = perf_counter()
+                try:
+                    self.agent.send(update)
+                except OSError:
+                    self.link_up.clear()
+                    self.agent.interrupt()  # wakes the receiving side, which waits for the client to resume the session
+                self.send_time.observe(perf_counter() - started)
+            sleep(self.UPDATE_PERIOD) # distance sensor
 
+    async def send_updates_async(self) -> None:
+        """
+        Same as send_updates, but sends and waits on the running event loop.
+
+        :Assumpitons: None
+
+        :return: None
+        """
+        while self.is_connection_alive:
+            if self.link_up.is_set():
+                update = self.__next_update()
+                started = perf_counter()
+                try:
+                    await self.agent.send_async(update)
+                except OSError:
+                    self.link_up.clear()
+                    self.agent.interrupt()  # wakes the receiving side, which waits for the client to resume the session
+                self.send_time.observe(perf_counter() - started)
+            await async_sleep(self.UPDATE_PERIOD)
+
+    def __next_update(self) -> bytes:
+        started = perf_counter()
+        values = self.controller.get_values(self.values)
+        self.get_values_time.observe(perf_counter() - started)
+        if self.telemetry_encoder is not None:
+            values = self.telemetry_encoder.encode(values)
+        return self.agent.protocol.encode(values)
 
 if __name__ == '__main__':
+    setup_logging(level=DEBUG if '--verbose' in argv else INFO,
+                  file=argv[argv.index('--log-file') + 1] if '--log-file' in argv else None)
+
+    if '--port' in argv:
+        LAN_Agent.PORT = int(argv[argv.index('--port') + 1])
+
+    if '--simulate' in argv:
+        set_backend(SimulatedBackend())
+
     if len(argv) > 1 and argv[1] == '--debug':
         b = DS4Agent()
     else:
-        RC_Car().run()
+        metrics_port = int(argv[argv.index('--metrics-port') + 1]) if '--metrics-port' in argv else None
+        command_timeout = argv[argv.index('--command-timeout') + 1] if '--command-timeout' in argv else Watchdog.TIMEOUT
+        RC_Car(delta_telemetry='--delta-telemetry' in argv, asynchronous='--asyncio' in argv,
+               metrics_port=metrics_port,
+               command_timeout=None if command_timeout == 'off' else float(command_timeout)).run()
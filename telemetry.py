@@ -0,0 +1,62 @@
+from utils.constants import SEQUENCE, KEYFRAME
+
+
+class DeltaEncoder:
+    """
+    Turns consecutive snapshots of the controller state into telemetry messages, which only contain the keys that
+    changed since the previous message. Every KEYFRAME_INTERVAL-th message is a full keyframe, so a client which
+    missed a message (detected by a gap in the sequence numbers) can resynchronise.
+
+    :examples:
+    >>> encoder = DeltaEncoder()
+    >>> encoder.encode({'forward': True, 'distance': 20.0})
+    {'seq': 0, 'keyframe': True, 'forward': True, 'distance': 20.0}
+    >>> encoder.encode({'forward': True, 'distance': 18.5})
+    {'seq': 1, 'keyframe': False, 'distance': 18.5}
+    """
+
+    KEYFRAME_INTERVAL = 20  # one full state per second with the 50 ms update period
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL):
+        """
+        :param keyframe_interval: number of messages between two consecutive keyframes
+        """
+        assert 1 <= keyframe_interval
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self.last_values = None
+
+    def request_keyframe(self) -> None:
+        """
+        Forces the next message to be a keyframe, e.g. after the client reported a gap.
+
+        :return: None
+        """
+        self.last_values = None
+
+    def encode(self, values: dict) -> dict:
+        """
+        Creates the next telemetry message.
+
+        :Assumptions: None
+
+        :param values: the current state of the car as key-value pairs
+
+        :return: the message, containing the sequence number, the keyframe flag and the changed key-value pairs
+        """
+        keyframe = self.sequence % self.keyframe_interval == 0 or self.last_values is None
+        message = {SEQUENCE: self.sequence, KEYFRAME: keyframe}
+
+        if keyframe:
+            message.update(values)
+        else:
+            for key, value in values.items():
+                if key not in self.last_values or self.last_values[key] != value:
+                    message[key] = value
+
+        if self.last_values is None:
+            self.last_values = dict(values)
+        else:
+            self.last_values.update(values)  # the keys of the state are fixed, so no copy is needed
+        self.sequence += 1
+        return message
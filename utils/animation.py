@@ -0,0 +1,158 @@
+from functools import lru_cache
+from threading import Lock
+from typing import Iterator, Iterable, Optional
+
+from utils.metrics import metrics
+
+INF = -1
+
+
+class Animation:
+    """
+    Precomputed brightness values of an LED animation, one for every frame of the engine playing it.
+
+    :examples:
+    >>> animation = Animation.blink(50, times=2, on_time=0.1, off_time=0.1, fade_in_time=0.1, fade_out_time=0.1)
+    >>> list(animation.frames())[:5]
+    [0.2, 0.4, 0.6, 0.8, 1.0]
+    """
+
+    def __init__(self, cycle: tuple, tail: int, times: int):
+        """
+        :param cycle: the values of one repetition
+        :param tail: the number of values played in the last repetition, the ones after it are skipped
+        :param times: the number of repetitions, INF for repeating until stopped
+        """
+        assert times == INF or 1 <= times
+        self.cycle = cycle
+        self.tail = tail
+        self.times = times
+
+    def frames(self) -> Iterator[float]:
+        """
+        :return: iterator over the values of the whole animation
+        """
+        played = 0
+        while True:
+            played += 1
+            if self.times != INF and played >= self.times:
+                yield from self.cycle[:self.tail]
+                return
+            yield from self.cycle
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def blink(frame_rate: float, times: int = 1, on_time: float = 0.5, off_time: float = 0.5, fade_in_time: float = 1,
+              fade_out_time: float = 1, max_value: float = 1) -> 'Animation':
+        """
+        Linear fade in, on, linear fade out, off. The tables are cached, so blinking with the same timing again does
+        not compute anything.
+
+        :Assumptions: None
+
+        :param frame_rate: frames per second of the engine playing the animation
+        :param times: the number of blinks, INF for blinking until stopped
+        :param on_time: seconds at full brightness
+        :param off_time: seconds off between two blinks, not played after the last one
+        :param fade_in_time: seconds to reach full brightness
+        :param fade_out_time: seconds to turn off from full brightness
+        :param max_value: full brightness
+
+        :return: the animation
+        """
+        fade_in_frames = max(1, round(fade_in_time * frame_rate))
+        fade_out_frames = max(1, round(fade_out_time * frame_rate))
+        fade_in = [(frame + 1) / fade_in_frames for frame in range(fade_in_frames)]
+        on = [1.0] * round(on_time * frame_rate)
+        fade_out = [(fade_out_frames - frame - 1) / fade_out_frames for frame in range(fade_out_frames)]
+        off = [0.0] * round(off_time * frame_rate)
+
+        cycle = tuple(round(value * max_value, 2) for value in fade_in + on + fade_out + off)
+        return Animation(cycle, len(cycle) - len(off), times)
+
+
+class AnimationEngine:
+    """
+    Plays the animations of every LED from a single behaviour, which updates all of them in one step per frame, so no
+    thread is needed per LED. The animations started together stay in sync, as they are advanced by the same frames.
+
+    :examples:
+    >>> engine = AnimationEngine()
+    >>> control_loop.start(engine.run())
+    >>> engine.play([left_indicator, right_indicator], Animation.blink(engine.frame_rate, times=INF))
+    >>> engine.stop(left_indicator)
+    """
+
+    FRAME_RATE = 50
+
+    def __init__(self, frame_rate: float = FRAME_RATE):
+        """
+        :param frame_rate: frames per second
+        """
+        self.frame_rate = frame_rate
+        self.period = 1 / frame_rate
+        self.channels = dict()  # LED -> iterator over the remaining values of its animation, replaced on every change
+        self.lock = Lock()  # held while a frame is written, and while the channels are replaced
+        self.running = False
+        metrics.gauge('animation.channels', lambda: len(self.channels))
+
+    def play(self, leds: Iterable, animation: Animation) -> None:
+        """
+        Starts the animation on the LEDs from the next frame, replacing their current animations.
+
+        :Assumptions: None
+
+        :param leds: objects with a _write(value) method
+        :param animation: the animation to play
+
+        :return: None
+        """
+        with self.lock:
+            self.channels = {**self.channels, **{led: animation.frames() for led in leds}}
+
+    def stop(self, led, value: Optional[float] = None) -> None:
+        """
+        Stops the animation of the LED, and writes its new value, while no frame is being written, so the frame in
+        progress on the thread of the engine does not overwrite it.
+
+        :Assumptions: None
+
+        :param led: an object with a _write(value) method
+        :param value: written to the LED, after its animation is stopped, nothing is written if None
+
+        :return: None
+        """
+        with self.lock:
+            if led in self.channels:
+                self.channels = {other: frames for other, frames in self.channels.items() if other is not led}
+            if value is not None:
+                led._write(value)
+
+    def run(self) -> Iterator[float]:
+        """
+        Writes the next value of every animation on every frame, the finished animations are removed.
+
+        :Assumptions: It is started only once at a time
+
+        :return: generator yielding the time until the next frame
+        """
+        self.running = True
+        while self.running:
+            finished = []
+            with self.lock:
+                channels = self.channels
+                for led, frames in channels.items():
+                    value = next(frames, None)
+                    if value is None:
+                        finished.append(led)
+                    else:
+                        led._write(value)
+                if finished:
+                    self.channels = {led: frames for led, frames in channels.items() if led not in finished}
+            yield self.period
+
+    def close(self) -> None:
+        """
+        Stops the run behaviour, the LEDs keep their current values.
+        """
+        self.running = False
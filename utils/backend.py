@@ -0,0 +1,240 @@
+from atexit import register
+from collections import deque
+from time import monotonic
+from typing import Iterator, Optional
+
+from utils.runtime import ThreadRuntime
+from utils.output_batch import BufferedPWM, BufferedWheel
+
+
+class GPIOBackend:
+    """
+    Creates the devices on the GPIO pins of the Raspberry Pi. The GPIO libraries are only imported, when the backend
+    is created, so the rest of the software can be imported on any machine. The outputs are written through the
+    output batch.
+    """
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        register(GPIO.cleanup)
+        self.gpio = GPIO
+
+    def pwm(self, pin: int, frequency: float) -> BufferedPWM:
+        self.gpio.setup(pin, self.gpio.OUT)
+        return BufferedPWM(self.gpio.PWM(pin, frequency))
+
+    def wheel(self, forward_pin: int, backward_pin: int) -> BufferedWheel:
+        from gpiozero import Motor as Wheel
+        return BufferedWheel(Wheel(forward_pin, backward_pin))
+
+    def distance_sensor(self, echo: int, trigger: int):
+        from gpiozero import DistanceSensor
+        return DistanceSensor(echo=echo, trigger=trigger)
+
+    def line_sensor(self, pin: int):
+        from gpiozero import LineSensor
+        return LineSensor(pin)
+
+    def cleanup(self) -> None:
+        self.gpio.cleanup()
+
+
+class SimulatedWorld:
+    """
+    The surroundings of the simulated car: the distance of the closest obstacle, and whether the car is on a line.
+    The values can be set directly, or follow a script of (seconds since start, distance in meters, line detected)
+    entries, which is played by the run behaviour.
+
+    :examples:
+    >>> world = SimulatedWorld([(0, 1.0, False), (2, 0.1, False), (4, 1.0, True)])
+    >>> ThreadRuntime().start(world.run())
+    """
+
+    STEP = 0.01
+
+    def __init__(self, script: Optional[list] = None, distance: float = 1.0, line: bool = False):
+        """
+        :param script: (seconds since start, distance in meters, line detected) entries in chronological order
+        :param distance: the distance until the script changes it, in meters
+        :param line: whether a line is detected until the script changes it
+        """
+        self.script = deque(script or [])
+        self.distance = distance
+        self.line = line
+        self.line_listeners = []
+
+    def set_line(self, line: bool) -> None:
+        if line != self.line:
+            self.line = line
+            for listener in self.line_listeners:
+                listener(line)
+
+    def run(self) -> Iterator[float]:
+        """
+        Plays the script.
+
+        :Assumptions: None
+
+        :return: generator yielding the time until the next check of the script
+        """
+        start = monotonic()
+        while self.script:
+            while self.script and self.script[0][0] <= monotonic() - start:
+                _, self.distance, line = self.script.popleft()
+                self.set_line(line)
+            yield self.STEP
+
+
+class SimulatedPWM:
+    """
+    In-memory replacement of RPi.GPIO.PWM, which records the duty cycle changes with their time.
+    """
+
+    HISTORY = 10000
+
+    def __init__(self, pin: int, frequency: float):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+        self.running = False
+        self.history = deque(maxlen=self.HISTORY)  # (monotonic time, duty cycle) pairs
+
+    def start(self, duty_cycle: float) -> None:
+        self.running = True
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        assert 0 <= duty_cycle <= 100
+        self.duty_cycle = duty_cycle
+        self.history.append((monotonic(), duty_cycle))
+
+    def ChangeFrequency(self, frequency: float) -> None:
+        self.frequency = frequency
+
+    def stop(self) -> None:
+        self.running = False
+
+
+class SimulatedWheel:
+    """
+    In-memory replacement of gpiozero.Motor, driving a simulated PWM output on both of its pins.
+    """
+
+    def __init__(self, forward_pwm: SimulatedPWM, backward_pwm: SimulatedPWM):
+        self.forward_pwm = forward_pwm
+        self.backward_pwm = backward_pwm
+
+    @property
+    def value(self) -> float:
+        return (self.forward_pwm.duty_cycle - self.backward_pwm.duty_cycle) / 100
+
+    def forward(self, speed: float = 1) -> None:
+        assert 0 <= speed <= 1
+        self.backward_pwm.ChangeDutyCycle(0)
+        self.forward_pwm.ChangeDutyCycle(speed * 100)
+
+    def backward(self, speed: float = 1) -> None:
+        assert 0 <= speed <= 1
+        self.forward_pwm.ChangeDutyCycle(0)
+        self.backward_pwm.ChangeDutyCycle(speed * 100)
+
+    def stop(self) -> None:
+        self.forward_pwm.ChangeDutyCycle(0)
+        self.backward_pwm.ChangeDutyCycle(0)
+
+
+class SimulatedDistanceSensor:
+
+    def __init__(self, world: SimulatedWorld):
+        self.world = world
+
+    @property
+    def distance(self) -> float:
+        return self.world.distance
+
+
+class SimulatedLineSensor:
+
+    def __init__(self, world: SimulatedWorld):
+        self.when_line = None
+        self.when_no_line = None
+        world.line_listeners.append(self.__line_changed)
+
+    def __line_changed(self, line: bool) -> None:
+        callback = self.when_line if line else self.when_no_line
+        if callback is not None:
+            callback()
+
+
+class SimulatedBackend:
+    """
+    Creates in-memory devices instead of the GPIO ones, so the whole software can run, and be benchmarked on any
+    machine. The simulated sensors are driven by the world of the backend, the PWM outputs are kept by pin, so their
+    history can be inspected. The outputs are written through the output batch, like the GPIO ones, so the history
+    only contains the writes reaching the hardware.
+
+    :examples:
+    >>> set_backend(SimulatedBackend(SimulatedWorld(distance=0.5)))
+    >>> controller = Controller()
+    >>> get_backend().pwms[7].duty_cycle
+    0
+    """
+
+    def __init__(self, world: Optional[SimulatedWorld] = None):
+        """
+        :param world: the surroundings of the car, the script of the world is started with the backend
+        """
+        self.world = world or SimulatedWorld()
+        self.pwms = dict()
+        if self.world.script:
+            ThreadRuntime().start(self.world.run())
+
+    def pwm(self, pin: int, frequency: float) -> BufferedPWM:
+        return BufferedPWM(self.__simulated_pwm(pin, frequency))
+
+    def wheel(self, forward_pin: int, backward_pin: int) -> BufferedWheel:
+        wheel = SimulatedWheel(self.__simulated_pwm(forward_pin, 100), self.__simulated_pwm(backward_pin, 100))
+        wheel.stop()
+        return BufferedWheel(wheel)
+
+    def __simulated_pwm(self, pin: int, frequency: float) -> SimulatedPWM:
+        self.pwms[pin] = SimulatedPWM(pin, frequency)
+        return self.pwms[pin]
+
+    def distance_sensor(self, echo: int, trigger: int) -> SimulatedDistanceSensor:
+        return SimulatedDistanceSensor(self.world)
+
+    def line_sensor(self, pin: int) -> SimulatedLineSensor:
+        return SimulatedLineSensor(self.world)
+
+    def cleanup(self) -> None:
+        for pwm in self.pwms.values():
+            pwm.stop()
+
+
+_backend = None
+
+
+def set_backend(backend) -> None:
+    """
+    Selects the backend creating the devices, it has to be called before the first device is created.
+
+    :Assumptions: None
+
+    :param backend: GPIOBackend or SimulatedBackend instance
+
+    :return: None
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    """
+    :return: the selected backend, GPIOBackend if none was selected
+    """
+    global _backend
+    if _backend is None:
+        _backend = GPIOBackend()
+    return _backend
@@ -20,6 +20,9 @@ DISTANCE        = 'distance'
 SPEED           = 'speed'
 LINE            = 'line'
 
+THROTTLE        = 'throttle'  # -1 (full speed backward) ... 1 (full speed forward)
+STEERING        = 'steering'  # -1 (full left) ... 1 (full right)
+
 STOP            = 0
 ACCELERATING    = 1
 SPEEDING        = 2
@@ -27,6 +30,7 @@ BREAKING        = -1
 DISTANCE_STATE  = 3
 LINE_STATE      = 4
 CONTAIN_STATE   = 5
+ANALOG_STATE    = 6
 
 LIGHTS_OFF  = 0
 LIGHTS_ON   = 1
@@ -36,4 +40,11 @@ LEFT_ON     = 4
 
 SUCCESS                 = 1
 AGENT_CONNECTED         = 0
-AUTHENTICATION_FAILURE  = -1
\ No newline at end of file
+AUTHENTICATION_FAILURE  = -1
+
+SEQUENCE        = 'seq'
+KEYFRAME        = 'keyframe'
+
+BOOLEAN_FIELDS  = (FORWARD, BACKWARD, LEFT, RIGHT, REVERSE, KEEP_CONTAINED, CHANGE_DIRECTION, DISTANCE_KEEPING,
+                   LINE_FOLLOWING, R_INDICATOR, L_INDICATOR, HAZARD_WARNING, LIGHTS, HORN, LINE)
+NUMERIC_FIELDS  = (DISTANCE, SPEED, THROTTLE, STEERING)
@@ -0,0 +1,109 @@
+from collections import deque
+from time import monotonic, perf_counter
+from typing import Iterator
+
+from utils.runtime import Runtime, Worker
+from utils.metrics import metrics
+from utils.log import get_logger
+
+logger = get_logger('control_loop')
+
+
+class ControlLoop(Runtime):
+    """
+    Fixed rate scheduler for the behaviours, which drive the actuators. Instead of sleeping on their own, the
+    behaviours are stepped from a single loop, on the ticks at or after their wake up time. The ticks are scheduled
+    to absolute deadlines, so timing errors do not accumulate, and every tick finishing after the next deadline is
+    counted as an overrun.
+
+    The behaviours have the same form as in utils.runtime: generators yielding the seconds to wait before their next
+    step. As all of them are stepped from the same loop, a behaviour replaced by one started with the same key never
+    overlaps with its replacement. The loop itself is such a behaviour, so it is started by a runtime too.
+
+    :examples:
+    >>> control_loop = ControlLoop(frequency=50)
+    >>> ThreadRuntime().start(control_loop.run())
+    >>> control_loop.start(motor_ramp())
+    >>> control_loop.stop()
+    """
+
+    FREQUENCY = 50
+
+    def __init__(self, frequency: float = FREQUENCY):
+        """
+        :param frequency: number of ticks per second
+        """
+        assert 0 < frequency
+        super().__init__()
+        self.period = 1 / frequency
+        self.scheduled = []  # [wake up time, worker] pairs
+        self.pending = deque()  # workers started since the last tick, can be appended from any thread
+        self.tick_listeners = []  # called after every tick, e.g. to write the outputs changed by the behaviours
+        self.running = False
+        self.ticks = 0
+        self.overruns = 0
+        self.tick_time = metrics.histogram('control_loop.tick')
+        metrics.gauge('control_loop.overruns', lambda: self.overruns)
+        metrics.gauge('control_loop.workers', lambda: self.live)
+
+    def _launch(self, worker: Worker) -> None:
+        self.pending.append(worker)  # the first step is done on the next tick
+
+    def stop(self) -> None:
+        self.running = False
+
+    def run(self) -> Iterator[float]:
+        """
+        The loop of the scheduler, it runs until stop is called.
+
+        :Assumptions: It is started only once at a time
+
+        :return: generator yielding the time remaining until the next deadline
+        """
+        self.running = True
+        deadline = monotonic()
+        while self.running:
+            started = perf_counter()
+            self.tick(deadline)
+            self.tick_time.observe(perf_counter() - started)
+            deadline += self.period
+
+            now = monotonic()
+            if now > deadline:
+                self.overruns += 1
+                deadline += (now - deadline) // self.period * self.period  # skip the ticks missed entirely
+            yield max(0.0, deadline - now)
+
+    def tick(self, now: float) -> None:
+        """
+        Does one step of every behaviour, which is due.
+
+        :Assumptions: None
+
+        :param now: the deadline of the tick, the wake up times are computed from it, not from the actual time
+
+        :return: None
+        """
+        self.ticks += 1
+        while self.pending:
+            self.scheduled.append([now, self.pending.popleft()])
+
+        for entry in list(self.scheduled):
+            wake_up_time, worker = entry
+            if worker.cancelled.is_set():
+                self.__remove(entry)
+            elif wake_up_time <= now:
+                try:
+                    entry[0] = max(wake_up_time + next(worker.behaviour), now)  # a late behaviour does not build up lag
+                except StopIteration:
+                    self.__remove(entry)
+                except Exception:
+                    logger.exception('Behaviour %s stopped with exception', worker.behaviour)
+                    self.__remove(entry)
+
+        for listener in self.tick_listeners:
+            listener()
+
+    def __remove(self, entry: list) -> None:
+        self.scheduled.remove(entry)
+        self._finish(entry[1])
@@ -0,0 +1,85 @@
+from itertools import count
+from time import sleep
+
+from utils.constants import BOOLEAN_FIELDS
+from utils.metrics import metrics
+
+snapshot_retries = metrics.counter('state.snapshot_retries')
+
+DEFAULTS = dict.fromkeys(BOOLEAN_FIELDS, False)
+
+
+class ControlState(dict):
+    """
+    State of the car, or of a command, as a dict holding every boolean field of the protocol, the missing fields read
+    as False. The Controller, the Motor and the Lights share one object, and each of them writes only its own fields.
+    Loading a command and taking a snapshot are single dict operations, so they do not touch the fields one by one.
+
+    The fields changed together are written inside a with block, which marks the state as being written, and gives
+    it a new version when it ends. It does not lock, so it never blocks the writers. The snapshot is taken again, if
+    a write was in progress, or the version changed while it was copied, so it never contains half of an update,
+    e.g. forward and backward both True.
+
+    :examples:
+    >>> state = ControlState()
+    >>> with state:
+    ...     state[FORWARD] = True
+    ...     state[BACKWARD] = False
+    >>> state[FORWARD], state[HORN], THROTTLE in state
+    (True, False, False)
+    >>> state.snapshot(values)  # fills the same dict on every call
+    """
+
+    __slots__ = ('writers', 'version', 'versions')
+
+    def __init__(self):
+        super().__init__(DEFAULTS)
+        self.writers = []  # one item per write in progress, appending and popping are atomic
+        self.versions = count(1)  # taking the next version is atomic
+        self.version = 0
+
+    def __missing__(self, field: str) -> bool:
+        return False
+
+    def __enter__(self) -> 'ControlState':
+        self.writers.append(None)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.version = next(self.versions)
+        self.writers.pop()
+
+    def load(self, values: dict) -> 'ControlState':
+        """
+        Replaces the content with a decoded command, the boolean fields missing from it are False.
+
+        :Assumptions: None
+
+        :param values: the key-value pairs of the command
+
+        :return: self
+        """
+        self.clear()  # the numbers of the previous command
+        self.update(DEFAULTS)
+        self.update(values)
+        return self
+
+    def snapshot(self, values: dict) -> dict:
+        """
+        Copies the fields into the dict, so the same dict can be reused for every snapshot. It is copied again, until no
+        write overlapped the copy.
+
+        :Assumptions: It is not called inside a with block of the same state, that would never return
+
+        :param values: filled with the fields
+
+        :return: values
+        """
+        while True:
+            version = self.version
+            if not self.writers:
+                values.update(self)
+                if not self.writers and self.version == version:
+                    return values
+            snapshot_retries.increment()
+            sleep(0)  # lets the writer finish
@@ -0,0 +1,92 @@
+from atexit import register
+from logging import getLogger, Logger, Filter, Formatter, LogRecord, StreamHandler, FileHandler, INFO
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from time import monotonic
+from typing import Optional
+
+ROOT_LOGGER = 'rc_car'
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+
+def get_logger(name: str) -> Logger:
+    """
+    :param name: name of the module, it is prefixed with the name of the root logger of the software
+
+    :return: the logger of the module
+    """
+    return getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+class RateLimitFilter(Filter):
+    """
+    Drops the repetitions of a log message (same logger, level and text) within the interval. The number of dropped
+    repetitions is appended to the next message let through. It renders the message to compare it, so it is meant to
+    be added to the handler writing the messages, on the background thread.
+    """
+
+    INTERVAL = 1.0
+    MAX_ENTRIES = 1024  # the entries older than the interval are removed, when there are more messages than this
+
+    def __init__(self, interval: float = INTERVAL):
+        """
+        :param interval: seconds, within which a message is only logged once
+        """
+        super().__init__()
+        self.interval = interval
+        self.last_logged = dict()  # (logger, level, message) -> [time logged, repetitions dropped since]
+
+    def filter(self, record: LogRecord) -> bool:
+        key = (record.name, record.levelno, record.getMessage())
+        now = monotonic()
+        entry = self.last_logged.get(key)
+        if entry is not None and now - entry[0] < self.interval:
+            entry[1] += 1
+            return False
+
+        if entry is not None and entry[1]:
+            record.msg = f'{record.msg} ({entry[1]} similar messages suppressed)'
+        self.last_logged[key] = [now, 0]
+        if len(self.last_logged) > self.MAX_ENTRIES:
+            self.last_logged = {key: entry for key, entry in self.last_logged.items() if now - entry[0] < self.interval}
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts the records into the queue as they are, so the message is formatted by the background thread.
+    """
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        return record
+
+
+def setup_logging(level: int = INFO, file: Optional[str] = None,
+                  rate_limit: float = RateLimitFilter.INTERVAL) -> None:
+    """
+    Configures the loggers of the software. The records are only put into a queue by the logging thread, formatting
+    and writing them is done by a background thread, so a slow terminal or SD card does not slow down the caller.
+    Without calling it, only the warnings and errors are written to stderr, by the default handler of logging.
+
+    :Assumptions: It is called once, before the first message is logged
+
+    :param level: the minimal level of the logged messages, the messages below it are dropped without formatting
+    :param file: path of the log file, the messages are written to stderr if None
+    :param rate_limit: seconds, within which a repeated message is only logged once
+
+    :return: None
+    """
+    queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(queue)
+
+    logger = getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    writer = FileHandler(file) if file is not None else StreamHandler()
+    writer.setFormatter(Formatter(FORMAT))
+    writer.addFilter(RateLimitFilter(rate_limit))
+    listener = QueueListener(queue, writer)
+    listener.start()
+    register(listener.stop)
@@ -0,0 +1,174 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Thread
+from typing import Callable, Iterator
+
+from utils.log import get_logger
+
+logger = get_logger('metrics')
+
+
+class Counter:
+    """
+    Monotonically increasing count. Incrementing it is a single addition, no lock is taken, so a concurrent
+    increment may very rarely be lost, which is acceptable for monitoring.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def increment(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of durations in seconds, counted into fixed buckets, so observing a value does not allocate.
+
+    :examples:
+    >>> histogram = Histogram()
+    >>> histogram.observe(0.0003)
+    >>> histogram.snapshot()['count']
+    1
+    """
+
+    BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, bounds: tuple = BOUNDS):
+        """
+        :param bounds: the upper bounds of the buckets in increasing order, an additional bucket counts the larger
+            values
+        """
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, ratio: float) -> float:
+        """
+        :return: the upper bound of the bucket containing the quantile, the maximum for the last bucket
+        """
+        rank = ratio * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class Gauge:
+    """
+    Value read from the instrumented component, when a snapshot is taken.
+    """
+
+    def __init__(self, read: Callable[[], float]):
+        self.read = read
+
+    def snapshot(self) -> float:
+        return self.read()
+
+
+class Metrics:
+    """
+    Registry of the metrics of the software. The metrics are created on first use, so the instrumented modules only
+    have to know their names.
+
+    :examples:
+    >>> metrics.counter('agent.messages_received').increment()
+    >>> metrics.histogram('controller.set_values').observe(0.0002)
+    >>> metrics.gauge('threads', active_count)
+    >>> metrics.snapshot()['agent.messages_received']
+    1
+    """
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def counter(self, name: str) -> Counter:
+        if name not in self.metrics:
+            self.metrics[name] = Counter()
+        return self.metrics[name]
+
+    def histogram(self, name: str) -> Histogram:
+        if name not in self.metrics:
+            self.metrics[name] = Histogram()
+        return self.metrics[name]
+
+    def gauge(self, name: str, read: Callable[[], float]) -> Gauge:
+        self.metrics[name] = Gauge(read)
+        return self.metrics[name]
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in sorted(self.metrics.items())}
+
+    def log_snapshots(self, period: float) -> Iterator[float]:
+        """
+        Logs a snapshot of the metrics periodically.
+
+        :Assumptions: None
+
+        :param period: seconds between two snapshots
+
+        :return: generator yielding the time until the next snapshot
+        """
+        while True:
+            yield period
+            logger.info('metrics: %s', dumps(self.snapshot()))
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """
+        Serves the snapshot of the metrics as JSON on http://host:port/metrics from a background thread.
+
+        :Assumptions: None
+
+        :param port: the port to listen on
+        :param host: the address to listen on, only local clients are served by default
+
+        :return: the server, it can be stopped with its shutdown method
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = dumps(registry.snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = Metrics()
@@ -0,0 +1,143 @@
+from threading import Lock
+
+from utils.metrics import metrics
+
+
+class OutputBatch:
+    """
+    Collects the changed outputs, so they are written together once per control cycle, instead of on every
+    assignment. Writing an output is skipped, if its value did not change since it was last written, so an output
+    set several times in a cycle is written at most once, with its last value.
+
+    Until it is deferred, the outputs are written right away, so the devices work without a control loop too.
+
+    :examples:
+    >>> output_batch.defer(control_loop)  # flushed after every tick from now on
+    >>> output_batch.flush_immediately()  # written right away again
+    """
+
+    def __init__(self):
+        self.pending = set()  # outputs changed since the last flush
+        self.lock = Lock()  # the outputs are changed from the threads of the agents as well
+        self.deferred = False
+        self.writes = metrics.counter('outputs.writes')
+        self.skipped_writes = metrics.counter('outputs.skipped_writes')
+
+    def changed(self, output) -> None:
+        if not self.deferred:
+            output.flush()
+            return
+
+        with self.lock:
+            self.pending.add(output)
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        for output in pending:
+            output.flush()
+
+    def defer(self, control_loop) -> None:
+        """
+        Writes the changed outputs after every tick of the control loop from now on.
+
+        :Assumptions: It is called once per control loop
+
+        :param control_loop: the ControlLoop, after whose ticks the outputs are written
+
+        :return: None
+        """
+        control_loop.tick_listeners.append(self.flush)
+        self.deferred = True
+
+    def flush_immediately(self) -> None:
+        """
+        Writes the pending outputs, and writes the changes right away from now on.
+        """
+        self.deferred = False
+        self.flush()
+
+
+output_batch = OutputBatch()
+
+
+class BufferedPWM:
+    """
+    Same interface as RPi.GPIO.PWM, but the duty cycle changes go through the output batch.
+    """
+
+    def __init__(self, pwm, batch: OutputBatch = output_batch):
+        """
+        :param pwm: the PWM output written on flush
+        :param batch: collects the changes until the end of the control cycle
+        """
+        self.pwm = pwm
+        self.batch = batch
+        self.duty_cycle = None  # the latest value set
+        self.written = None  # the value last written to the PWM output
+
+    def start(self, duty_cycle: float) -> None:
+        self.pwm.start(duty_cycle)
+        self.duty_cycle = self.written = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        self.duty_cycle = duty_cycle
+        self.batch.changed(self)
+
+    def ChangeFrequency(self, frequency: float) -> None:
+        self.pwm.ChangeFrequency(frequency)
+
+    def stop(self) -> None:
+        self.pwm.stop()
+
+    def flush(self) -> None:
+        duty_cycle = self.duty_cycle
+        if duty_cycle == self.written:
+            self.batch.skipped_writes.increment()
+            return
+        self.pwm.ChangeDutyCycle(duty_cycle)
+        self.written = duty_cycle
+        self.batch.writes.increment()
+
+
+class BufferedWheel:
+    """
+    Same interface as gpiozero.Motor, but the speed changes go through the output batch.
+    """
+
+    def __init__(self, wheel, batch: OutputBatch = output_batch):
+        """
+        :param wheel: the motor driver written on flush
+        :param batch: collects the changes until the end of the control cycle
+        """
+        self.wheel = wheel
+        self.batch = batch
+        self.value = 0  # the latest speed set, negative backward
+        self.written = None  # the speed last written to the motor driver
+
+    def forward(self, speed: float = 1) -> None:
+        self.value = speed
+        self.batch.changed(self)
+
+    def backward(self, speed: float = 1) -> None:
+        self.value = -speed
+        self.batch.changed(self)
+
+    def stop(self) -> None:
+        self.value = 0
+        self.batch.changed(self)
+
+    def flush(self) -> None:
+        value = self.value
+        if value == self.written:
+            self.batch.skipped_writes.increment()
+            return
+
+        if value > 0:
+            self.wheel.forward(value)
+        elif value < 0:
+            self.wheel.backward(-value)
+        else:
+            self.wheel.stop()
+        self.written = value
+        self.batch.writes.increment()
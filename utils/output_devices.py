@@ -1,23 +1,19 @@
-from RPi.GPIO import PWM, OUT, setup
 from time import sleep
-from threading import Thread
-from atexit import register
-import RPi.GPIO as GPIO
+from typing import Iterator
 
-GPIO.setmode(GPIO.BCM)
-register(GPIO.cleanup)
+from utils.runtime import ThreadRuntime
+from utils.backend import get_backend
+from utils.animation import Animation, AnimationEngine, INF
 
 class GeneralPurposeOutputDevice:
 
     def __init__(self, pin: int, starting_value: float=0, max_value: float=1):
         assert 0.1 <= max_value <= 1
         assert 0 <= starting_value <= max_value
-        setup(pin, OUT)
         self._value = starting_value
-        self._device = PWM(pin, 50)
+        self._device = get_backend().pwm(pin, 50)
         self._device.start(self._value * 100)
         self._max_value = max_value
-        self._is_active_background = False
 
     @property
     def value(self):
@@ -28,7 +24,6 @@ class GeneralPurposeOutputDevice:
         assert 0 <= new_value <= self._max_value
         self._value = new_value
         self._device.ChangeDutyCycle(self._value * 100)
-        self._is_active_background = False
 
     def on(self):
         self.value = self._max_value
@@ -68,18 +63,34 @@ class Buzzer(GeneralPurposeOutputDevice):
 
 class LED(GeneralPurposeOutputDevice):
 
-    INF = -1
+    INF = INF
 
-    def __init__(self, pin: int, starting_value: float=0, max_value: float=1):
+    def __init__(self, pin: int, starting_value: float=0, max_value: float=1, runtime=None, engine=None):
+        """
+        :param runtime: plays the non-blocking animations in a behaviour per LED, if there is no engine
+        :param engine: plays the non-blocking animations together with the ones of the other LEDs
+        """
         super().__init__(pin, starting_value, max_value)
+        self._runtime = runtime or ThreadRuntime()
+        self._engine = engine
+
+    @property
+    def value(self):
+        return self._value
 
-    def _active_sleep(self, seconds):
-        int_seconds = int(seconds // 1 * 100)
-        int_deciseconds = int(seconds % 1 * 10 // 1 * 10)
-        for _ in range(int_seconds + int_deciseconds):
-            if not self._is_active_background:
-                break
-            sleep(0.01)
+    @value.setter
+    def value(self, new_value: float):
+        if self._engine is not None:
+            assert 0 <= new_value <= self._max_value
+            self._engine.stop(self, new_value)  # not overwritten by the frame being played
+            return
+        self.__stop_animation()
+        GeneralPurposeOutputDevice.value.fset(self, new_value)
+
+    def _write(self, value: float) -> None:
+        """Sets the value, without stopping the animation"""
+        self._value = value
+        self._device.ChangeDutyCycle(self._value * 100)
 
     def blink(self, times=1, on_time=0.5, off_time=0.5, fade_in_time=1, fade_out_time=1, non_blocking=False):
         assert times == self.INF or 1 <= times
@@ -88,49 +99,28 @@ class LED(GeneralPurposeOutputDevice):
         assert 0 < fade_in_time
         assert 0 < fade_out_time
 
-        self._is_active_background = True  
+        frame_rate = self._engine.frame_rate if self._engine is not None else AnimationEngine.FRAME_RATE
+        animation = Animation.blink(frame_rate, times, on_time, off_time, fade_in_time, fade_out_time, self._max_value)
+        if not non_blocking:
+            self.__stop_animation()
+            for value in animation.frames():
+                self._write(value)
+                sleep(1 / frame_rate)
+        elif self._engine is not None:
+            self._engine.play([self], animation)
+        else:
+            self._runtime.start(self.__play(animation, 1 / frame_rate), self)  # replaces the previous animation
+
+    def __play(self, animation: Animation, period: float) -> Iterator[float]:
+        for value in animation.frames():
+            self._write(value)
+            yield period
 
-        if non_blocking:
-            Thread(target=self.blink, args=(times, on_time, off_time, fade_in_time, fade_out_time)).start()
+    def __stop_animation(self) -> None:
+        if self._engine is not None:
+            self._engine.stop(self)
         else:
-            counter = 0
-            upper_bound = int(self._max_value * 100)
-            self._value = 0
-
-            while(self._is_active_background):
-                for _ in range(0, upper_bound):
-                    if not self._is_active_background:
-                        break
-                    
-                    new_value = self.value + 0.01
-                    if new_value > 1:
-                        new_value = 1
-
-                    self._value = new_value
-                    self._device.ChangeDutyCycle(self._value * 100)
-                    
-                    sleep(fade_in_time/upper_bound)
-
-                self._active_sleep(on_time)
-
-                for _ in range(upper_bound, 0, -1):
-                    if not self._is_active_background:
-                        break
-                    
-                    new_value = self.value - 0.01
-                    if new_value < 0:
-                        new_value = 0
-
-                    self._value = new_value
-                    self._device.ChangeDutyCycle(self._value * 100)
-
-                    sleep(fade_out_time/upper_bound)
-
-                counter += 1
-                if times == self.INF or counter < times:
-                    self._active_sleep(off_time)
-                else:
-                    self._is_active_background = False
+            self._runtime.cancel(self)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+from asyncio import AbstractEventLoop, sleep as async_sleep
+from threading import Thread, Event, Lock
+from typing import Iterator, Optional, Hashable
+
+
+class Worker:
+    """
+    Handle of a started behaviour. A cancelled behaviour does not take any more steps.
+    """
+
+    def __init__(self, behaviour: Iterator[float], key: Optional[Hashable] = None,
+                 previous: Optional['Worker'] = None):
+        """
+        :param behaviour: generator yielding the seconds to wait between its steps
+        :param key: the key the behaviour was started with
+        :param previous: the worker replaced by this one, it has to finish before this one takes its first step
+        """
+        self.behaviour = behaviour
+        self.key = key
+        self.previous = previous
+        self.cancelled = Event()
+        self.finished = Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def finish(self) -> None:
+        self.behaviour.close()
+        self.previous = None
+        self.finished.set()
+
+
+class Runtime:
+    """
+    Base of the classes running the behaviours.
+
+    A behaviour is a generator, which does one step of its work, then yields the number of seconds to wait before the
+    next step. It finishes when the generator returns, or when it is cancelled.
+
+    A behaviour can be started with a key, in which case the previous behaviour started with the same key is
+    cancelled, and the new one only takes its first step after the previous one finished, so there is at most one
+    worker per key.
+    """
+
+    def __init__(self):
+        self.workers = dict()
+        self.live = 0  # number of workers started but not finished yet
+        self.live_lock = Lock()
+
+    def start(self, behaviour: Iterator[float], key: Optional[Hashable] = None) -> Worker:
+        """
+        Starts the behaviour, replacing the one started with the same key.
+
+        :Assumptions: None
+
+        :param behaviour: generator yielding the seconds to wait between its steps
+        :param key: identifies the behaviours, which must not run at the same time
+
+        :return: the handle of the started behaviour
+        """
+        previous = self.workers.get(key) if key is not None else None
+        if previous is not None:
+            previous.cancel()
+
+        worker = Worker(behaviour, key, previous)
+        if key is not None:
+            self.workers[key] = worker
+
+        with self.live_lock:
+            self.live += 1
+        self._launch(worker)
+        return worker
+
+    def cancel(self, key: Hashable) -> None:
+        """
+        Cancels the behaviour started with the key, if there is one.
+
+        :Assumptions: None
+
+        :param key: the key the behaviour was started with
+
+        :return: None
+        """
+        worker = self.workers.pop(key, None)
+        if worker is not None:
+            worker.cancel()
+
+    def _launch(self, worker: Worker) -> None:
+        raise NotImplementedError
+
+    def _finish(self, worker: Worker) -> None:
+        if worker.key is not None and self.workers.get(worker.key) is worker:
+            self.workers.pop(worker.key, None)
+        worker.finish()
+        with self.live_lock:
+            self.live -= 1
+
+
+class ThreadRuntime(Runtime):
+    """
+    Runs every behaviour in its own thread.
+
+    :examples:
+    >>> def countdown():
+    ...     for i in range(3, 0, -1):
+    ...         print(i)
+    ...         yield 1
+    >>> ThreadRuntime().start(countdown())
+    """
+
+    def _launch(self, worker: Worker) -> None:
+        Thread(target=self.__run, args=(worker,)).start()
+
+    def __run(self, worker: Worker) -> None:
+        try:
+            if worker.previous is not None:
+                worker.previous.finished.wait()
+
+            while not worker.cancelled.is_set():
+                delay = next(worker.behaviour, None)
+                if delay is None:
+                    break
+                worker.cancelled.wait(delay)
+        finally:
+            self._finish(worker)
+
+
+class AsyncioRuntime(Runtime):
+    """
+    Runs every behaviour as a task on a single asyncio event loop, so no thread is created per behaviour.
+    The behaviours can be started from any thread. As every step runs on the loop, a replaced behaviour can not be
+    in the middle of a step, when the new one starts.
+    """
+
+    def __init__(self, loop: Optional[AbstractEventLoop] = None):
+        """
+        :param loop: the event loop to run the behaviours on, it can be set later, but before the first behaviour
+            is started
+        """
+        super().__init__()
+        self.loop = loop
+        self.tasks = set()  # the loop only keeps weak references to the tasks
+
+    def _launch(self, worker: Worker) -> None:
+        assert self.loop is not None
+        self.loop.call_soon_threadsafe(self.__create_task, worker)
+
+    def __create_task(self, worker: Worker) -> None:
+        task = self.loop.create_task(self.__run(worker))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __run(self, worker: Worker) -> None:
+        try:
+            while not worker.cancelled.is_set():
+                delay = next(worker.behaviour, None)
+                if delay is None:
+                    break
+                await async_sleep(delay)
+        finally:
+            self._finish(worker)
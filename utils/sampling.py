@@ -0,0 +1,80 @@
+from collections import deque
+from statistics import median
+from typing import Iterator
+
+
+class DistanceSampler:
+    """
+    Reads the distance sensor at its own rate, so neither the updates nor the motor have to wait for the echo.
+    The readings are kept in a ring buffer, and the median of the buffer removes the single noisy readings. The
+    median is published as value for the motor, and an exponential moving average of it as smoothed for the
+    telemetry. Both are published by a single assignment, so they can be read from any thread without locking.
+
+    With the default 3 readings, a step of the distance shows in value at the second reading after it, so 1-2
+    periods (60-120 ms) after the step. The smoothed value crosses the middle of the step at the same reading, and
+    covers 90% of the step one reading later.
+
+    :examples:
+    >>> sampler = DistanceSampler(DistanceSensor(echo=4, trigger=3))
+    >>> ThreadRuntime().start(sampler.run())
+    >>> sampler.value  # in centimeters
+    42.0
+    """
+
+    PERIOD      = 0.06  # the echo of the previous measurement has to fade before the next one
+    WINDOW      = 3     # every reading the median is computed from delays the steps by half a period
+    SMOOTHING   = 0.7   # weight of the new median in the moving average of the telemetry
+
+    def __init__(self, sensor, period: float = PERIOD, window: int = WINDOW, smoothing: float = SMOOTHING,
+                 initial_value: float = 100.0):
+        """
+        :param sensor: the distance sensor, its distance is measured in meters
+        :param period: seconds between two readings
+        :param window: number of readings the median is computed from
+        :param smoothing: weight of the new median in the moving average of the smoothed value, 1 means no smoothing
+        :param initial_value: the value published until the first reading, in centimeters
+        """
+        assert 0 < period
+        assert 1 <= window
+        assert 0 < smoothing <= 1
+        self.sensor = sensor
+        self.period = period
+        self.smoothing = smoothing
+        self.readings = deque(maxlen=window)
+        self.value = initial_value
+        self.smoothed = initial_value
+        self.running = False
+
+    def stop(self) -> None:
+        self.running = False
+
+    def sample(self) -> float:
+        """
+        Reads the sensor once, and publishes the new median and smoothed values.
+
+        :Assumptions: It is called from one thread at a time
+
+        :return: the new median in centimeters
+        """
+        self.readings.append(self.sensor.distance * 100)
+        filtered = median(self.readings)
+        self.value = filtered
+        if len(self.readings) > 1:
+            self.smoothed = self.smoothing * filtered + (1 - self.smoothing) * self.smoothed
+        else:
+            self.smoothed = filtered
+        return filtered
+
+    def run(self) -> Iterator[float]:
+        """
+        Samples the sensor until stop is called. Reading the sensor blocks for the echo time, so it should be
+        started on a ThreadRuntime, not on the control loop or the event loop.
+
+        :Assumptions: It is started only once at a time
+
+        :return: generator yielding the time until the next reading
+        """
+        self.running = True
+        while self.running:
+            self.sample()
+            yield self.period
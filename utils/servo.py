@@ -1,6 +1,10 @@
-import RPi.GPIO as gpio
 from time import sleep
 
+from utils.backend import get_backend
+from utils.log import get_logger
+
+logger = get_logger('servo')
+
 
 class Servo:
     """
@@ -9,11 +13,10 @@ class Servo:
 
     def __init__(self, pin, initial_angle=0, min_duty=2, max_duty=12):
         assert min_duty < max_duty
-        gpio.setup(pin, gpio.OUT)
         self._min_duty = min_duty
         self._max_duty = max_duty
         self._scale_number = 180 / (self._max_duty - self._min_duty)
-        self.servo = gpio.PWM(pin, 50)
+        self.servo = get_backend().pwm(pin, 50)
         self.servo.start(0)
         self._angle = (initial_angle + 90) / 18 + 2
         self.servo.ChangeDutyCycle(self._angle)
@@ -21,8 +24,8 @@ class Servo:
 
     def __del__(self):
         self.servo.stop()
-        gpio.cleanup()
-        print("del ran")
+        get_backend().cleanup()
+        logger.debug("del ran")
 
     @property
     def angle(self):
@@ -82,4 +85,5 @@ class Servo:
 # GPIO.cleanup()
 
 if __name__ == "__main__":
-
+    s = Servo(25)
+    s.mid()
@@ -0,0 +1,56 @@
+from time import monotonic
+from typing import Callable, Iterator
+
+from utils.metrics import metrics
+from utils.log import get_logger
+
+logger = get_logger('watchdog')
+
+
+class Watchdog:
+    """
+    Calls its action, if it is not fed for longer than the timeout. It triggers once per starvation, it is armed
+    again by the next feed. Its run behaviour is meant to be started on the control loop, so the starvation is
+    detected within a tick.
+
+    :examples:
+    >>> watchdog = Watchdog(0.5, motor.brake)
+    >>> control_loop.start(watchdog.run())
+    >>> watchdog.feed()  # on every valid command
+    """
+
+    TIMEOUT = 0.5
+
+    def __init__(self, timeout: float = TIMEOUT, action: Callable[[], None] = lambda: None):
+        """
+        :param timeout: seconds without feeding, after which the action is called
+        :param action: called from the runtime of the run behaviour, when the watchdog triggers
+        """
+        assert 0 < timeout
+        self.timeout = timeout
+        self.action = action
+        self.last_fed = monotonic()
+        self.triggered = False
+        self.triggers = metrics.counter('watchdog.triggers')
+        metrics.gauge('watchdog.timeout', lambda: self.timeout)
+        metrics.gauge('watchdog.since_fed', lambda: monotonic() - self.last_fed)
+
+    def feed(self) -> None:
+        self.last_fed = monotonic()
+        self.triggered = False
+
+    def run(self) -> Iterator[float]:
+        """
+        Checks the time since the last feed.
+
+        :Assumptions: None
+
+        :return: generator yielding 0, so it checks on every tick of the control loop
+        """
+        while True:
+            if not self.triggered and monotonic() - self.last_fed > self.timeout:
+                self.triggered = True
+                self.triggers.increment()
+                logger.warning('no command for %s s, braking', self.timeout)
+                self.action()
+            yield 0